@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Benchmarks for backuppurge, run from a source checkout:
+#
+#     python benchmark.py [--sizes 1000,100000,1000000] [--json results.json]
+#
+# Synthetic backup series are generated in memory (and on disk for the
+# "directory" case), and the time spent in each phase of PurgeList as well
+# as end to end is measured, together with the peak memory usage.
+#
+# The "sharded" case compares parsing in one process with --jobs processes.
+#
+# With --startup, the import time (from "python -X importtime") and the
+# wall clock time of running the command line interface are measured, too.
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+sys.path.insert(0, LIB_DIR)
+
+import backuppurge
+
+TODAY = datetime.datetime(2026, 10, 17, 12, 0)
+
+POLICY = backuppurge.Policy(days=30, months=6, years=5, hours=48)
+
+MINUTES_PER_DAY = 24 * 60
+
+# Numbers of processes for the "sharded" case (see --jobs)
+JOBS = [1, 2, 4]
+
+
+def listdir_find_backups(directory, include_directories):
+    """
+    Reference implementation: os.listdir() plus one or two stat() per entry
+    """
+    return filter(lambda f: (include_directories and os.path.isdir(f)) or os.path.isfile(f),
+                  map(lambda filename: os.path.join(directory, filename), os.listdir(directory)))
+
+
+class StatCounter:
+    """
+    Count stat() calls made through the os module while active
+
+    Calls that os.scandir() makes internally (e.g. for symlinks or on
+    filesystems that do not report file types) are not visible here.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self.saved = (os.stat, os.lstat)
+
+        def wrap(func):
+            def wrapper(*args, **kwargs):
+                self.count += 1
+                return func(*args, **kwargs)
+            return wrapper
+
+        os.stat, os.lstat = map(wrap, self.saved)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.stat, os.lstat = self.saved
+
+
+def generate_filenames(entries, series=1, per_day=1):
+    """
+    Generate names for backup series, newest first
+
+    Each of the series gets entries/series backups, per_day of them per
+    day (with a time of day if there is more than one backup per day).
+    """
+    minutes = MINUTES_PER_DAY // per_day
+    filenames = []
+    for index in range(series):
+        prefix = 'host{0:04d}-'.format(index) if series > 1 else 'backup-'
+        for offset in range(entries // series):
+            date = TODAY - datetime.timedelta(minutes=(offset + 1) * minutes)
+            if per_day > 1:
+                filenames.append(date.strftime(prefix + '%Y-%m-%dT%H%M.tgz'))
+            else:
+                filenames.append(date.strftime(prefix + '%Y-%m-%d.tgz'))
+
+    return filenames
+
+
+def make_backup_directory(filenames, noise=0.1):
+    """
+    Create a temporary directory with the given backup files and some noise
+    """
+    directory = tempfile.mkdtemp(prefix='backuppurge-bench-')
+
+    for filename in filenames:
+        open(os.path.join(directory, filename), 'w').close()
+
+    for index in range(int(len(filenames) * noise)):
+        open(os.path.join(directory, 'unrelated-{0}.txt'.format(index)), 'w').close()
+
+    return directory
+
+
+class Results:
+    """
+    Collect (case, entries, phase) measurements
+    """
+    def __init__(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def measure(self, case, entries, phase):
+        started = time.time()
+        yield
+        self.add(case, entries, phase, time.time() - started)
+
+    def add(self, case, entries, phase, seconds):
+        self.records.append({'case': case, 'entries': entries, 'phase': phase,
+                             'seconds': seconds})
+        print('{0:>14} {1:>9} {2:<24} {3:9.3f} s'.format(case, entries, phase, seconds),
+              file=sys.stderr)
+
+    def peak_memory(self, func):
+        """Run func again with tracemalloc, add peak usage to the last record"""
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.records[-1]['peak_bytes'] = peak
+        print('{0:>14} {1:>9} {2:<24} {3:9.1f} MiB'.format('', '', 'peak memory',
+              peak / 1024. / 1024.), file=sys.stderr)
+
+
+def bench_purge_list(results, case, filenames):
+    entries = len(filenames)
+
+    with results.measure(case, entries, 'check_file_list'):
+        purge_list = backuppurge.PurgeList(filenames, TODAY, None)
+
+    for tier in ('hourly', 'daily', 'monthly', 'yearly'):
+        keep = getattr(purge_list, 'keep_' + tier)
+        with results.measure(case, entries, 'keep_' + tier):
+            keep(getattr(POLICY, {'hourly': 'hours', 'daily': 'days',
+                                  'monthly': 'months', 'yearly': 'years'}[tier]))
+
+    def end_to_end():
+        backuppurge.purge_filenames(filenames, TODAY, POLICY, None, False)
+
+    with results.measure(case, entries, 'end_to_end'):
+        end_to_end()
+    results.peak_memory(end_to_end)
+
+
+def bench_multi_series(results, case, filenames):
+    entries = len(filenames)
+
+    with results.measure(case, entries, 'group_series'):
+        backuppurge.group_series(filenames)
+
+    def end_to_end():
+        backuppurge.purge_filenames(filenames, TODAY, POLICY, None, True)
+
+    with results.measure(case, entries, 'end_to_end'):
+        end_to_end()
+    results.peak_memory(end_to_end)
+
+
+def bench_sharded(results, case, filenames):
+    entries = len(filenames)
+
+    expected = None
+    for jobs in JOBS:
+        # Parent CPU time shows how much of the work is left in the parent
+        cpu = time.process_time()
+        with results.measure(case, entries, 'get_purge_lists[jobs={0}]'.format(jobs)):
+            purge_lists = backuppurge.get_purge_lists(filenames, TODAY, POLICY, None, True,
+                                                      jobs=jobs)
+        results.records[-1]['parent_cpu_seconds'] = time.process_time() - cpu
+
+        purged = [purge_list.get_filenames() for purge_list in purge_lists]
+        if expected is None:
+            expected = purged
+        elif purged != expected:
+            raise AssertionError('Result with --jobs {0} differs'.format(jobs))
+
+
+def bench_directory(results, case, filenames):
+    entries = len(filenames)
+    directory = make_backup_directory(filenames)
+    try:
+        for name, find_backups in (('listdir', listdir_find_backups),
+                                   ('scandir', backuppurge.find_backups)):
+            with StatCounter() as counter:
+                with results.measure(case, entries, 'find_backups[{0}]'.format(name)):
+                    for _ in find_backups(directory, False):
+                        pass
+            results.records[-1]['stat_calls'] = counter.count
+
+        def end_to_end():
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    backuppurge.main(directory, POLICY.days, POLICY.months, POLICY.years,
+                                     '\n', False, None)
+                finally:
+                    sys.stdout = stdout
+
+        with results.measure(case, entries, 'main'):
+            end_to_end()
+        results.peak_memory(end_to_end)
+    finally:
+        shutil.rmtree(directory)
+
+
+def import_time(module):
+    """
+    Cumulative import time of module in seconds, from "python -X importtime"
+    """
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c',
+                                      'import ' + module],
+                                     stderr=subprocess.STDOUT, env=env)
+    for line in output.decode('utf-8').splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+
+
+def bench_startup(results, runs):
+    # Best of runs, to filter out noise from other processes
+    for module in ('backuppurge', 'backuppurge.cli'):
+        results.add('startup', 0, 'import ' + module,
+                    min(import_time(module) for _ in range(runs)))
+
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    directory = make_backup_directory(generate_filenames(10), noise=0)
+    try:
+        for name, command in (('python -m backuppurge', ['-m', 'backuppurge']),
+                              ('backuppurge script', [os.path.join(os.path.dirname(
+                                  LIB_DIR), 'backuppurge')])):
+            timings = []
+            for _ in range(runs):
+                started = time.time()
+                subprocess.check_call([sys.executable] + command + [directory],
+                                      stdout=subprocess.DEVNULL, env=env)
+                timings.append(time.time() - started)
+            results.add('startup', 10, name, min(timings))
+    finally:
+        shutil.rmtree(directory)
+
+
+CASES = {
+    # One series spread over 10 years, several backups per day for big sizes
+    'single': lambda entries: (bench_purge_list, generate_filenames(
+        entries, per_day=max(1, -(-entries // 3650)))),
+    # 100 series with one backup per day each
+    'multi-series': lambda entries: (bench_multi_series, generate_filenames(
+        entries, series=100)),
+    # One series with one backup per hour
+    'hourly': lambda entries: (bench_purge_list, generate_filenames(
+        entries, per_day=24)),
+    # 100 series as in a large inventory, parsed in 1, 2, 4, ... processes
+    'sharded': lambda entries: (bench_sharded, generate_filenames(
+        entries, series=100, per_day=max(1, -(-entries // 365000)))),
+    # One series with one backup per day, as files in a directory
+    'directory': lambda entries: (bench_directory, generate_filenames(
+        entries, per_day=max(1, -(-entries // 36500)))),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', default='1000,100000,1000000', type=str,
+            help='Comma-separated numbers of backups to generate')
+    parser.add_argument('-c', '--cases', default=','.join(sorted(CASES)), type=str,
+            help='Comma-separated cases to run ({0})'.format(', '.join(sorted(CASES))))
+    parser.add_argument('--max-directory-entries', default=100000, type=int,
+            help='Largest size for which files are created on disk')
+    parser.add_argument('--json', default=None, type=str, metavar='FILE',
+            help='Write results as JSON to FILE (- for stdout)')
+    parser.add_argument('--no-numpy', action='store_true', default=False,
+            help='Do not use NumPy even if it is installed')
+    parser.add_argument('--jobs', default='1,2,4', type=str,
+            help='Comma-separated numbers of processes for the "sharded" case')
+    parser.add_argument('--startup', action='store_true', default=False,
+            help='Also measure import and command line startup time')
+    parser.add_argument('--startup-runs', default=10, type=int,
+            help='Number of runs for --startup (the fastest one is reported)')
+    args = parser.parse_args()
+
+    JOBS = [int(jobs) for jobs in args.jobs.split(',')]
+
+    if args.no_numpy:
+        backuppurge.NUMPY_MIN_ENTRIES = None
+
+    results = Results()
+    if args.startup:
+        bench_startup(results, args.startup_runs)
+
+    for entries in map(int, args.sizes.split(',')):
+        for case in filter(None, args.cases.split(',')):
+            if case == 'directory' and entries > args.max_directory_entries:
+                continue
+
+            bench, filenames = CASES[case](entries)
+            bench(results, case, filenames)
+
+    if args.json is not None:
+        report = {
+            'python': sys.version.split()[0],
+            'numpy': backuppurge.get_numpy(backuppurge.NUMPY_MIN_ENTRIES or 0) is not None,
+            'version': backuppurge.__version__,
+            'results': results.records,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as fp:
+                json.dump(report, fp, indent=2)
@@ -36,7 +36,21 @@ for *YEARS* years. Monthly and yearly backups are always the oldest possible
 daily backup (e.g. first of month and first of year that is available).
 
 Files are expected to have their date embedded as ``YYYY-MM-DD`` somewhere in
-the filename, e.g. ``homedir-2013-03-31.tgz``
+the filename, e.g. ``homedir-2013-03-31.tgz``. The date can be followed by a
+time of day as ``[T_ ]HH[MM[SS]]``, e.g. ``db-2013-03-31T0300.sql.gz``, for
+multiple backups per day. With --hours, hourly backups are kept for *HOURS*
+hours (the first backup of each hour), and daily backups are the first
+backup of each day.
+
+For names with dates in another format, give it with --date-format as
+for strftime(), using ``%Y`` (or ``%y``), ``%m``, ``%d`` and optionally
+``%H``, ``%M`` and ``%S``, e.g. ``--date-format %Y%m%d_%H%M`` for
+``db_20130331_0300.sql.gz``. If given more than once, the first format
+found in a name is used. Each name is scanned for the shape of the date
+(its digits and separators) and parsed once, without a regular
+expression per format::
+
+    backuppurge --date-format %Y%m%d --date-format %Y.%m.%d /var/backups/db
 
 For monthly and yearly backups, the first day available will be kept (e.g.
 January 1st for yearly, but if that is not available, January 2nd will be
@@ -46,6 +60,24 @@ This program can be used together with xargs(1) from GNU findutils::
 
     backuppurge --print0 /var/backups/ | xargs -r -0 rm
 
+Backups to purge are written oldest first (per directory and series) and
+flushed in chunks of about 128 KiB, the size of a command line for xargs,
+so that deleting can start before all backups are written.
+
+Alternatively, --delete removes the files (and with --include-directories,
+directory trees) directly using --delete-workers threads, and prints a
+summary of the bytes and inodes freed to stderr.
+
+To keep deletes from hurting other services on the same disks, limit
+them to --delete-rate *OPS* files and directories and --delete-bandwidth
+*SIZE* bytes per second (directory trees are then removed one entry at a
+time), pause while removing an entry takes longer than
+--max-unlink-latency *MS* milliseconds, and/or delete with the I/O
+scheduling class given with --ionice (``idle`` or ``best-effort``, on
+Linux)::
+
+    backuppurge -D --delete --delete-rate 500 --delete-bandwidth 50M --ionice idle /srv/snapshots
+
 Only files directly in the specified **DIRECTORY** will be searched (in the
 above example, ``/var/backups/homedir-2013-03-31.tgz`` will be considered,
 but not ``/var/backups/etc/etc-2013-03-31.tgz``). This prevents accidental
@@ -53,6 +85,119 @@ deletion of files. If --include-directories (-D) is used, directories directly
 below the path will be included in the search (e.g. the directory
 ``/var/backups/etc-2015-07-24/`` will be included in the purge search).
 
+Files in **DIRECTORY** must all belong to the same series (same text before
+and after the date), unless --prefix (-p) selects one of them. With
+--all-series (-a), each series found in **DIRECTORY** is purged separately
+and the results are combined into one list.
+
+With --recursive (-r), every directory below **DIRECTORY** (up to
+--max-depth levels deep) is treated as a separate backup location, e.g.
+``/var/backups/<host>/<volume>/``. Directories are scanned concurrently and
+the purge list of each directory is written as soon as it is done.
+Directories with a date in their name are never descended into. Backups
+next to subdirectories are purged as a series of their own. Directories
+that cannot be purged (e.g. with mixed series) are skipped with an error,
+the rest of the tree is still purged, and the exit status is 1.
+
+Instead of a directory, **DIRECTORY** can be ``s3://bucket/prefix/`` to purge
+objects in an S3-compatible object store (requires boto3, set
+``$AWS_ENDPOINT_URL`` for e.g. MinIO), or ``-`` to read a list of paths
+from stdin (same as --from-stdin).
+
+With --from-file or --from-stdin, backup paths are read from a listing
+(one per line, or NUL-separated with --null-input) instead of scanning a
+directory. Listed paths are not checked with stat() unless --verify-input
+is given, so existing inventories can be purged without touching the disk.
+
+With --max-total-size, backups kept by the policy above are purged until
+their total size is at most *SIZE* bytes (suffixes K, M, G and T are
+accepted), hourly backups first, then daily, monthly and yearly backups,
+oldest first within each tier. Sizes of files are collected while
+scanning, sizes of directory backups (--include-directories) are
+determined by walking the kept directories in parallel. With --recursive,
+the budget applies to each directory separately.
+
+With --stats, the wall time and counters (entries listed, stat calls, date
+matches, lookups, files kept and purged) of each phase are written to stderr
+as JSON, or in Prometheus text format (e.g. for the node_exporter textfile
+collector, use --stats-file).
+
+Multiple directories can be given, and further directories can be listed
+in an INI-style --config file, one section per directory, with options
+*days*, *months*, *years*, *hours* and *max-total-size* to override the
+command line policy for that directory (or for all in ``[DEFAULT]``)::
+
+    [DEFAULT]
+    days = 14
+
+    [/var/backups/db]
+    hours = 48
+
+    [/var/backups/etc]
+    months = 12
+
+Instead of --hours, --days, --months and --years, the tiers can be given
+with --tiers (or *tiers* in the config file) as a comma-separated list of
+*TIER*:*COUNT*\ [:first|:last], where *TIER* is one of hourly, daily,
+weekly (ISO weeks), monthly, quarterly and yearly. For each of the *COUNT*
+most recent periods, the first (default) or last backup is kept, e.g.::
+
+    backuppurge --tiers daily:14,weekly:8:last,quarterly:8,yearly:10 /var/backups/db
+
+Directories are purged concurrently (--threads), with at most
+--per-device directories on the same filesystem at a time. The output
+for each directory is written as one block.
+
+If NumPy is installed, the dates of large listings (10000 backups or
+more) are parsed in bulk, and for long retention windows the backups to
+keep are found by bucketing all dates at once. The result is the same as
+without NumPy.
+
+With --jobs *N*, the names in the listing of a single **DIRECTORY** (or
+--from-file) are parsed in *N* processes, in chunks of 65536 names, and
+merged into the index of each series. The output is the same as with one
+process (the default), which is faster for small listings.
+
+With --plan, nothing is purged. Instead, every backup is written to
+stdout as JSON Lines (``--plan jsonl``) or CSV (``--plan csv``) with the
+decision (*keep* or *purge*), the highest tier it is kept for (*hourly*,
+*daily*, *monthly* or *yearly*), the bucket in that tier (e.g. ``2013-03``
+for a monthly backup), the date parsed from the name and the reason, in
+date order per series.
+
+To review before deleting, save the plan with --save-plan *FILE* (the
+same entries as ``--plan jsonl``, plus inode, size and modification time
+of each backup to purge), then delete exactly those backups later with
+--apply-plan *FILE*, without listing or evaluating the policy again.
+Backups that changed since are left alone. Progress is journaled in
+*FILE*\ ``.journal``, an interrupted --apply-plan continues where it
+stopped when run again::
+
+    backuppurge --save-plan plan.jsonl /var/backups/etc
+    less plan.jsonl
+    backuppurge --apply-plan plan.jsonl
+
+To see what a policy would do over time, --simulate *DAYS* replays a run
+on each of *DAYS* days starting today (or --simulate-from *DATE*),
+assuming each backup appears on its date and is gone once a run purged
+it. Instead of purging, one CSV line per day is written with the number
+and total size of the backups kept after that day's run and of those it
+purged, e.g. to compare policies over the last ten years::
+
+    backuppurge --simulate 3653 --simulate-from 2016-01-01 -d 14 -m 12 /var/backups/etc
+
+With --cache, directory listings and parsed filenames are cached below
+``$XDG_CACHE_HOME/backuppurge/``, and directories that have not been
+modified since the previous run are not listed again.
+
+With --watch, backuppurge keeps running instead of being started from
+cron: the directory is listed once, and new, moved and deleted entries
+are picked up through inotify (on Linux, polling every --watch-interval
+seconds elsewhere). Each backup is printed (or deleted, with --delete)
+once, as soon as it becomes purgeable::
+
+    backuppurge --watch --delete /var/backups/etc
+
 This script assumes daily backups are FULL backups, not incremental. For
 example, a full daily backup of your ``/etc`` can be created by adding
 (``crontab -e``) a command like the following to your crontab(5) file::
@@ -63,12 +208,28 @@ example, a full daily backup of your ``/etc`` can be created by adding
 
 from __future__ import print_function
 
-import logging
-import warnings
-
+# Modules that are only needed for some features (logging, warnings, json,
+# hashlib, shutil, threading, heapq, concurrent.futures) are imported where
+# they are used to keep startup time low for the common case.
 import datetime
+import bisect
+import array
 import re
 import os
+import sys
+import stat
+import time
+import contextlib
+import collections
+import itertools
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    scandir = None
+
+from os import fsdecode, fsencode
 
 __author__ = 'Thomas Perl <m@thp.io>'
 __license__ = 'Simplified BSD License'
@@ -90,139 +251,3036 @@ class NoBackupsFound(Warning):
     """
     pass
 
-warnings.simplefilter('always', NoBackupsFound)
 
+def warn_no_backups(message):
+    import warnings
+    warnings.simplefilter('always', NoBackupsFound)
+    warnings.warn(message, NoBackupsFound, stacklevel=2)
 
-def find_backups(directory, include_directories):
+
+class LazyLogger:
     """
-    Find backup files in directory
+    Stand-in for logging.getLogger(name) that only imports logging when needed
+
+    Debug and info messages are dropped without importing logging if nothing
+    else has imported (and thus configured) it yet. If set, configure is
+    called once before the first message is logged.
     """
-    return filter(lambda f: (include_directories and os.path.isdir(f)) or os.path.isfile(f),
-                  map(lambda filename: os.path.join(directory, filename), os.listdir(directory)))
+    configure = None
 
+    def __init__(self, name):
+        self.name = name
+        self.logger = None
 
-class PurgeList:
-    def __init__(self, filenames, today, prefix):
-        self.logger = logging.getLogger(self.__class__.__name__)
+    def get_logger(self):
+        if self.logger is None:
+            import logging
+            configure, LazyLogger.configure = LazyLogger.configure, None
+            if configure is not None:
+                configure()
+            self.logger = logging.getLogger(self.name)
+        return self.logger
 
-        self.filenames = filenames
-        self.today = today
-        self.prefix = prefix
+    def debug(self, *args):
+        if self.logger is not None or 'logging' in sys.modules:
+            self.get_logger().debug(*args)
 
-        # Check prefix of files (before date), bail out if not all equal
-        self.check_file_list()
+    def info(self, *args):
+        if self.logger is not None or 'logging' in sys.modules:
+            self.get_logger().info(*args)
 
-        # By default, purge everything
-        self.purge = set(self.filenames)
+    def warning(self, *args):
+        self.get_logger().warning(*args)
 
-    def check_file_list(self):
-        regex = re.compile(r'^(.*)(\d{4}-\d{2}-\d{2})(.*)$')
+    def error(self, *args):
+        self.get_logger().error(*args)
 
-        # Remove all filenames without a date string in them
-        self.filenames = list(filter(regex.match, self.filenames))
+# Prefix, date (YYYY-MM-DD with optional [T_ ]HH[MM[SS]] time) and postfix;
+# digits after the date that are not a valid time not followed by another
+# digit (e.g. a port in site-2013-03-31_8080.tar) are part of the postfix
+DATE_REGEX = re.compile(r'^(.*)(\d{4}-\d{2}-\d{2}'
+                        r'(?:[T_ ](?:[01]\d|2[0-3])(?:[0-5]\d(?:[0-5]\d)?)?(?!\d))?)(.*)$')
 
-        if self.prefix is not None:
-            self.filenames = [filename for filename in self.filenames
-                              if regex.match(filename).group(1) == self.prefix]
+# Length of YYYY-MM-DD, everything after it is the (optional) time of day
+DATE_LENGTH = 10
 
-        if len(self.filenames) == 0:
-            warnings.warn('File list is empty', NoBackupsFound)
-            return
+SECONDS_PER_DAY = 24 * 60 * 60
 
-        prefixes, _, postfixes = map(set, zip(*[regex.match(filename).groups()
-            for filename in self.filenames]))
+# Retention tiers, lowest first (purged first when over the size budget)
+TIERS = ('hourly', 'daily', 'weekly', 'monthly', 'quarterly', 'yearly')
 
-        if len(prefixes) != 1:
-            raise MixedFilenames('Non-unique prefixes: {0}'.format(prefixes))
+# Timestamp of the end of 9999-12-31 (see bucket_start())
+MAX_TIMESTAMP = datetime.date.max.toordinal() * SECONDS_PER_DAY
 
-        if len(postfixes) != 1:
-            raise MixedFilenames('Non-unique postfixes: {0}'.format(postfixes))
+# Days from 0001-01-01 to 1970-01-01 (the epoch of NumPy's datetime64)
+EPOCH_DAYS = 719162
 
-    def keep(self, filename, kind):
-        """Mark filename to be kept"""
-        if filename is None:
-            return
+# Purge lists with at least this many backups are indexed with NumPy, if
+# it is installed (None disables NumPy); dates are parsed in chunks
+NUMPY_MIN_ENTRIES = 10000
+PARSE_CHUNK_SIZE = 64 * 1024
 
-        if filename in self.purge:
-            self.logger.info('Keeping file for %s: %s', kind, filename)
-            self.purge.remove(filename)
-        else:
-            self.logger.debug('File for %s already kept: %s', kind, filename)
+# One get_first() lookup costs about as much as bucketing this many backups
+# with NumPy, which is only done if it saves time (for long windows)
+BUCKETS_PER_LOOKUP = 400
 
-    def get_all(self, year, month=None, day=None):
-        """Get all backups for a specific year"""
+# Output is flushed in chunks of this many bytes, the size of the command
+# buffer xargs uses by default, so that each chunk can start a command
+OUTPUT_CHUNK_SIZE = 128 * 1024
 
-        month_re = r'{0:02d}'.format(month) if month else r'\d{2}'
-        day_re = r'{0:02d}'.format(day) if day else r'\d{2}'
+# System call numbers of ioprio_set(2) and the I/O scheduling classes, see
+# set_io_priority()
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+              'ppc64le': 273, 's390x': 282}
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
 
-        regex = re.compile(r'{0:04d}-{1:s}-{2:s}'.format(year, month_re, day_re))
+# Directives of --date-format patterns (see DateFormat) and their widths
+DATE_FORMAT_FIELDS = {'Y': 4, 'y': 2, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
 
-        return sorted(filter(regex.search, self.filenames))
+# Translation tables mapping all digits to NUL (see DateFormat), for str
+# and for names encoded as Latin-1 (which keeps their offsets)
+DIGITS_TO_NUL = dict((ord(digit), 0) for digit in '0123456789')
+DIGITS_TO_NUL_BYTES = bytes(bytearray(0 if 48 <= i <= 57 else i for i in range(256)))
 
-    def get_first(self, year, month=None, day=None):
-        """Get first backup for a specific year, month or day
+# Suffixes for sizes given on the command line
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
 
-        get_first(2013) -> First available backup in 2013
-        get_first(2013, 3) -> First available backup in March 2013
-        get_first(2013, 3, 31) -> First available backup for March 31st 2013
+
+def parse_filename(filename):
+    """
+    Split filename into (prefix, date, postfix), or None if it has no date
+    """
+    match = DATE_REGEX.match(filename)
+    if match is None:
+        return None
+
+    return match.groups()
+
+
+class DateFormat:
+    """
+    Parser for filenames with dates in strftime()-style formats, e.g.
+    "%Y%m%d" or "%Y.%m.%d_%H%M" (see DATE_FORMAT_FIELDS), to be used
+    instead of parse_filename()
+
+    Each format is compiled into the shape of its dates, a string with a
+    NUL for every digit. To parse a filename, its digits are replaced with
+    NUL in one pass of bytes.translate() (str.translate() for names that
+    are not Latin-1), and the last occurrence of a shape is found with
+    rfind() (like the greedy DATE_REGEX). Dates inside a longer run of
+    digits or with an invalid month, day or time are skipped. Formats are
+    tried in the order given, so more specific ones should come first.
+
+    Dates are returned as parse_timestamp() expects them (YYYY-MM-DD, and
+    THHMMSS if the format has a time of day). Results are cached, so each
+    filename is only parsed once however often it is looked up; match()
+    parses without the cache, for names that are only looked up once.
+    """
+    def __init__(self, formats):
+        self.formats = list(formats)
+        self.shapes = [self.compile(format) for format in self.formats]
+        self.parsed = {}
+
+    def __repr__(self):
+        return 'DateFormat({0!r})'.format(self.formats)
+
+    def __getstate__(self):
+        # For worker processes (see parse_sharded()), without the cache
+        return {'formats': self.formats}
+
+    def __setstate__(self, state):
+        self.__init__(state['formats'])
+
+    @staticmethod
+    def compile(format):
+        """
+        Get (shape, encoded shape, year, month, day, time) for a format,
+        year is its (start, end) offsets, month and day their start offsets
+        and time the start offsets of hour, minute and second (None if not
+        in the format), or None if the format has no time of day
+        """
+        shape = []
+        offsets = {}
+        characters = iter(format)
+        for character in characters:
+            if character.isdigit():
+                raise ValueError('Digits are not supported in date formats: {0}'
+                                 .format(format))
+            elif character != '%':
+                shape.append(character)
+                continue
+
+            directive = next(characters, '')
+            if directive == '%':
+                shape.append('%')
+                continue
+            elif directive not in DATE_FORMAT_FIELDS:
+                raise ValueError('Unsupported directive %{0} in date format: {1}'
+                                 .format(directive, format))
+            elif directive in offsets or directive in 'Yy' and set(offsets) & set('Yy'):
+                raise ValueError('Repeated field in date format: {0}'.format(format))
+
+            offsets[directive] = len(shape)
+            shape.extend('\0' * DATE_FORMAT_FIELDS[directive])
+
+        if not (set(offsets) & set('Yy') and set(offsets) >= set('md')):
+            raise ValueError('Date format needs a year, month and day: {0}'.format(format))
+
+        shape = ''.join(shape)
+        try:
+            encoded = shape.encode('latin-1')
+        except UnicodeEncodeError:
+            # Only names that cannot be encoded either can have this date
+            encoded = None
+
+        year = offsets.get('Y', offsets.get('y'))
+        year = (year, year + (4 if 'Y' in offsets else 2))
+        time = None
+        if set(offsets) & set('HMS'):
+            time = tuple(offsets.get(directive) for directive in 'HMS')
+
+        return shape, encoded, year, offsets['m'], offsets['d'], time
+
+    @staticmethod
+    def scan(filename, digits, nul, shape, year, month, day, time):
         """
-        matches = self.get_all(year, month, day)
-        if matches:
-            return matches[0]
+        Find the last date with shape in filename (digits is filename with
+        digits replaced by nul) that is not part of a longer run of digits
+        and has a valid month, day and time, get (prefix, date, postfix)
+        """
+        length = len(shape)
+        start = digits.rfind(shape)
+        while start >= 0:
+            # Earlier candidates may overlap this one, e.g. in 20130331120000
+            candidate, start = start, digits.rfind(shape, 0, start + length - 1)
+            if (digits[candidate - 1:candidate] == nul or
+                    digits[candidate + length:candidate + length + 1] == nul):
+                continue
+
+            date = filename[candidate + year[0]:candidate + year[1]]
+            if len(date) == 2:
+                # Like strptime(): 69-99 are 1969-1999, 00-68 are 2000-2068
+                date = ('19' if date >= '69' else '20') + date
+
+            mm = filename[candidate + month:candidate + month + 2]
+            dd = filename[candidate + day:candidate + day + 2]
+            if not ('01' <= mm <= '12' and '01' <= dd <= '31'):
+                continue
+            date += '-' + mm + '-' + dd
+
+            if time is not None:
+                hhmmss = ['00' if offset is None else
+                          filename[candidate + offset:candidate + offset + 2]
+                          for offset in time]
+                if hhmmss[0] > '23' or hhmmss[1] > '59' or hhmmss[2] > '59':
+                    continue
+                date += 'T' + ''.join(hhmmss)
+
+            return (filename[:candidate], date, filename[candidate + length:])
 
         return None
 
-    def recent_days(self, count):
-        day = self.today
-        while count > 0:
-            yield (day.year, day.month, day.day)
-            day -= datetime.timedelta(days=1)
-            count -= 1
-
-    def recent_months(self, count):
-        month = (self.today.year, self.today.month)
-        while count > 0:
-            yield month
-            if month[1] == 1:
-                month = (month[0]-1, 12)
-            else:
-                month = (month[0], month[1]-1)
-            count -= 1
+    def __call__(self, filename):
+        """Split filename into (prefix, date, postfix), or None if it has no date"""
+        if filename in self.parsed:
+            return self.parsed[filename]
 
-    def recent_years(self, count):
-        year = self.today.year
-        while count > 0:
-            yield year
-            year -= 1
-            count -= 1
+        result = self.parsed[filename] = self.match(filename)
+        return result
 
-    def keep_daily(self, days):
-        for year, month, day in self.recent_days(days):
-            self.keep(self.get_first(year, month, day), 'daily')
+    def match(self, filename):
+        """Like calling the DateFormat, but without caching the result"""
+        try:
+            # Much faster than str.translate() (a table lookup per byte)
+            digits = filename.encode('latin-1').translate(DIGITS_TO_NUL_BYTES)
+            encoded, nul = True, b'\0'
+        except UnicodeEncodeError:
+            digits = filename.translate(DIGITS_TO_NUL)
+            encoded, nul = False, '\0'
 
-    def keep_monthly(self, months):
-        for year, month in self.recent_months(months):
-            self.keep(self.get_first(year, month),
-                    'monthly ({0}-{1:02d})'.format(year, month))
+        result = None
+        for shape, encoded_shape, year, month, day, time in self.shapes:
+            if encoded:
+                if encoded_shape is None:
+                    continue
+                shape = encoded_shape
 
-    def keep_yearly(self, years):
-        for year in self.recent_years(years):
-            self.keep(self.get_first(year), 'yearly ({0})'.format(year))
+            result = self.scan(filename, digits, nul, shape, year, month, day, time)
+            if result is not None:
+                break
 
-    def get_filenames(self):
-        return self.purge
+        return result
+
+
+def get_parser(date_formats=None):
+    """Get the filename parser for a list of date formats (see DateFormat)"""
+    if not date_formats:
+        return parse_filename
+
+    return DateFormat(date_formats)
+
+
+def parse_timestamp(date):
+    """
+    Parse a date string matched by DATE_REGEX into seconds since 0001-01-01
+    (None if the date or time is invalid)
+    """
+    time_of_day = date[DATE_LENGTH + 1:]
+    hour, minute, second = [int(time_of_day[i:i+2] or 0) for i in (0, 2, 4)]
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+
+    try:
+        ordinal = datetime.date(*map(int, date[:DATE_LENGTH].split('-'))).toordinal()
+    except ValueError:
+        return None
+
+    return (ordinal - 1) * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+
+
+def get_numpy(entries):
+    """
+    Get the numpy module to process entries backups, or None if it is not
+    installed or not worth importing (see NUMPY_MIN_ENTRIES)
+    """
+    if NUMPY_MIN_ENTRIES is None or entries < NUMPY_MIN_ENTRIES:
+        return None
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+def parse_timestamps(dates, numpy):
+    """
+    Vectorised parse_timestamp() for a list of date strings matched by
+    DATE_REGEX, returns an int64 array with -1 for invalid dates (or None
+    if not all dates are ASCII)
+    """
+    try:
+        # Dates are at most 17 characters, shorter ones are padded with NUL
+        data = numpy.array(dates, dtype='S17')
+    except UnicodeEncodeError:
+        return None
+
+    digits = data.view(numpy.uint8).reshape(len(dates), 17).astype(numpy.int64) - ord('0')
+    digits[:, DATE_LENGTH + 1:] = numpy.maximum(digits[:, DATE_LENGTH + 1:], 0)
+
+    def number(start, width):
+        value = digits[:, start]
+        for column in range(start + 1, start + width):
+            value = value * 10 + digits[:, column]
+        return value
+
+    year, month, day = number(0, 4), number(5, 2), number(8, 2)
+    hour, minute, second = number(11, 2), number(13, 2), number(15, 2)
+
+    valid = ((year >= datetime.MINYEAR) & (month >= 1) & (month <= 12) & (day >= 1) &
+             (hour <= 23) & (minute <= 59) & (second <= 59))
+
+    # Days since the epoch of the first of this and the next month
+    months = numpy.where(valid, (year - 1970) * 12 + month - 1, 0)
+    start = months.astype('datetime64[M]').astype('datetime64[D]').astype(numpy.int64)
+    end = (months + 1).astype('datetime64[M]').astype('datetime64[D]').astype(numpy.int64)
+    valid &= day <= end - start
+
+    days = start + EPOCH_DAYS + day - 1
+    return numpy.where(valid, days * SECONDS_PER_DAY + hour * 3600 + minute * 60 + second, -1)
+
+
+def bucket_of(period, timestamp):
+    """
+    Number of the period (see TIERS) timestamp is in: hours, days or weeks
+    since 0001-01-01, or year * 12 + month - 1 for months, that divided by
+    3 for quarters, and the year for years
+    """
+    if period == 'hourly':
+        return timestamp // 3600
+
+    days = timestamp // SECONDS_PER_DAY
+    if period == 'daily':
+        return days
+    elif period == 'weekly':
+        # 0001-01-01 is a Monday, so these are ISO weeks
+        return days // 7
+
+    date = datetime.date.fromordinal(days + 1)
+    if period == 'yearly':
+        return date.year
+
+    month = date.year * 12 + date.month - 1
+    return month // 3 if period == 'quarterly' else month
+
+
+def bucket_start(period, bucket):
+    """Timestamp of the start of a bucket (see bucket_of())"""
+    if period == 'hourly':
+        return bucket * 3600
+    elif period == 'daily':
+        return bucket * SECONDS_PER_DAY
+    elif period == 'weekly':
+        return bucket * 7 * SECONDS_PER_DAY
+    elif period == 'yearly':
+        year, month = bucket, 0
+    else:
+        year, month = divmod(bucket * 3 if period == 'quarterly' else bucket, 12)
+
+    if year < datetime.MINYEAR:
+        return 0
+    elif year > datetime.MAXYEAR:
+        return MAX_TIMESTAMP
+
+    return (datetime.date(year, month + 1, 1).toordinal() - 1) * SECONDS_PER_DAY
+
+
+def bucket_key(period, bucket):
+    """
+    Get the key of a bucket for plans and logging, e.g. '2013-03' (monthly),
+    '2013-W13' (weekly) or '2013-03-31 08:00' (hourly)
+    """
+    if period == 'hourly':
+        date = datetime.date.fromordinal(bucket // 24 + 1)
+        return '{0:04d}-{1:02d}-{2:02d} {3:02d}:00'.format(date.year, date.month, date.day,
+                                                           bucket % 24)
+    elif period == 'daily':
+        date = datetime.date.fromordinal(bucket + 1)
+        return '{0:04d}-{1:02d}-{2:02d}'.format(date.year, date.month, date.day)
+    elif period == 'weekly':
+        year, week, _ = datetime.date.fromordinal(bucket * 7 + 1).isocalendar()
+        return '{0}-W{1:02d}'.format(year, week)
+    elif period == 'monthly':
+        return '{0}-{1:02d}'.format(bucket // 12, bucket % 12 + 1)
+    elif period == 'quarterly':
+        return '{0}-Q{1}'.format(bucket // 4, bucket % 4 + 1)
+
+    return str(bucket)
+
+
+def parse_tiers(spec):
+    """
+    Parse a list of tiers like "daily:30,weekly:8:last,yearly:5" (tier,
+    number of periods to keep and optionally which backup to keep of each)
+    """
+    tiers = []
+    for item in spec.split(','):
+        fields = item.strip().split(':')
+        if len(fields) not in (2, 3) or not fields[1].isdigit():
+            raise ValueError('Invalid tier: {0}'.format(item))
+        tiers.append(Tier(fields[0], int(fields[1]), *fields[2:]))
+
+    return tiers
+
+
+def parse_size(size):
+    """
+    Parse a size in bytes with an optional K, M, G or T suffix (powers of 1024)
+    """
+    match = re.match(r'^(\d+)([KMGT]?)B?$', size.strip().upper())
+    if match is None:
+        raise ValueError('Invalid size: {0}'.format(size))
+
+    value, unit = match.groups()
+    return int(value) * SIZE_UNITS[unit]
+
+
+def date_range(year, month=None, day=None, hour=None):
+    """
+    Half-open range of timestamps covering a year, month, day or hour
+    """
+    if year < datetime.MINYEAR or year >= datetime.MAXYEAR:
+        return (0, 0)
+
+    if day:
+        start = (datetime.date(year, month, day).toordinal() - 1) * SECONDS_PER_DAY
+        if hour is not None:
+            start += hour * 3600
+            return (start, start + 3600)
+        return (start, start + SECONDS_PER_DAY)
+    elif month:
+        start = datetime.date(year, month, 1)
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    else:
+        start = datetime.date(year, 1, 1)
+        end = datetime.date(year + 1, 1, 1)
+
+    return ((start.toordinal() - 1) * SECONDS_PER_DAY,
+            (end.toordinal() - 1) * SECONDS_PER_DAY)
+
+
+class Tier:
+    """
+    Retention tier: keep the first (or last) backup of each of the count
+    most recent periods (hourly, daily, ..., see TIERS)
+    """
+    def __init__(self, period, count, pick='first'):
+        if period not in TIERS:
+            raise ValueError('Unknown tier: {0}'.format(period))
+        if pick not in ('first', 'last'):
+            raise ValueError('Pick must be first or last: {0}'.format(pick))
+
+        self.period = period
+        self.count = count
+        self.pick = pick
+
+    def __repr__(self):
+        return 'Tier({0!r}, {1}, {2!r})'.format(self.period, self.count, self.pick)
+
+    def __eq__(self, other):
+        return (isinstance(other, Tier) and
+                (self.period, self.count, self.pick) == (other.period, other.count, other.pick))
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Policy:
+    """
+    Retention policy: number of hourly, daily, monthly and yearly backups
+    to keep (0 disables a tier), or a list of tiers (see Tier) instead, and
+    optionally the maximum total size in bytes of the backups kept
+    """
+    def __init__(self, days=30, months=6, years=5, hours=0, max_total_size=None,
+                 tiers=None):
+        self.hours = hours
+        self.days = days
+        self.months = months
+        self.years = years
+        self.max_total_size = max_total_size
+        self.tiers = tiers
+
+    def __repr__(self):
+        if self.tiers is not None:
+            return 'Policy(tiers={0!r}, max_total_size={1})'.format(self.tiers,
+                                                                  self.max_total_size)
+
+        return ('Policy(days={0}, months={1}, years={2}, hours={3}, max_total_size={4})'
+                .format(self.days, self.months, self.years, self.hours,
+                        self.max_total_size))
+
+    def get_tiers(self):
+        """Get the list of tiers, in the order they are applied"""
+        if self.tiers is not None:
+            return self.tiers
+
+        return [Tier('hourly', self.hours), Tier('daily', self.days),
+                Tier('monthly', self.months), Tier('yearly', self.years)]
+
+    def apply(self, purge_list):
+        """Mark all files in purge_list to be kept according to the policy"""
+        for tier in self.get_tiers():
+            purge_list.keep_tier(tier)
+
+
+class Stats:
+    """
+    Wall time and counters for each phase of a purge run
+
+    Pass an instance as stats= to main() or the lower-level functions to
+    collect timings (list, parse, keep, output, delete) and counters
+    (entries listed, stat calls, regex matches, lookups, kept, purged).
+    Times of phases running in multiple threads are added up.
+    """
+    enabled = True
+
+    COUNTERS = ('entries_listed', 'stat_calls', 'regex_matches', 'lookups',
+                'kept', 'purged')
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = dict((name, 0) for name in self.COUNTERS)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.) + elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self):
+        import json
+        return json.dumps({'phases': self.phases, 'counters': self.counters},
+                          sort_keys=True)
+
+    def to_prometheus(self):
+        """Format as Prometheus text (e.g. for the node_exporter textfile collector)"""
+        lines = [
+            '# HELP backuppurge_phase_seconds Wall time spent in each phase.',
+            '# TYPE backuppurge_phase_seconds gauge',
+        ]
+        lines.extend('backuppurge_phase_seconds{{phase="{0}"}} {1:f}'.format(name, seconds)
+                     for name, seconds in sorted(self.phases.items()))
+
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE backuppurge_{0} gauge'.format(name))
+            lines.append('backuppurge_{0} {1}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, format, filename=None):
+        """Write stats as 'json' or 'prometheus' to filename (default: stderr)"""
+        report = self.to_json() + '\n' if format == 'json' else self.to_prometheus()
+        if filename is None:
+            sys.stderr.write(report)
+            return
+
+        # Write atomically, as the file may be read by a collector at any time
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            fp.write(report)
+        os.rename(tmp_filename, filename)
+
+
+class NullStats:
+    """
+    Stand-in for Stats that records nothing
+    """
+    enabled = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def count(self, name, value=1):
+        pass
+
+NO_STATS = NullStats()
+
+
+def read_paths(stream, separator=None, chunk_size=1024*1024):
+    """
+    Read paths from a binary stream in large chunks and yield them
+
+    Paths are separated by separator (NUL or newline). If no separator is
+    given, NUL is used if the first chunk contains one, newline otherwise.
+    """
+    remainder = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        if separator is None:
+            separator = b'\0' if b'\0' in chunk else b'\n'
+
+        paths = (remainder + chunk).split(separator)
+        remainder = paths.pop()
+        for path in paths:
+            if path:
+                yield fsdecode(path)
+
+    if remainder:
+        yield fsdecode(remainder)
+
+
+def find_backups(directory, include_directories, subdirectories=None, stats=NO_STATS,
+                 sizes=None, parser=parse_filename):
+    """
+    Find backup files in directory
+
+    Entries are yielded lazily. Names without a date (see parser) are
+    skipped before any stat() call is made, and the file type cached by
+    os.scandir() is used to tell files and directories apart where
+    available.
+
+    If subdirectories is a list, directories without a date in their name
+    (candidates for a recursive search) are appended to it while iterating.
+    If sizes is a dictionary, the size of each backup file found is stored
+    in it (directories are left out, see disk_usage()).
+    """
+    # Names are only checked here, the paths are parsed again later on
+    if parser is parse_filename:
+        match = DATE_REGEX.match
+    else:
+        match = getattr(parser, 'match', parser)
+
+    if scandir is None:
+        filenames = os.listdir(directory)
+        stats.count('entries_listed', len(filenames))
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if match(filename) is None:
+                if subdirectories is not None:
+                    stats.count('stat_calls', 2)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        subdirectories.append(path)
+                continue
+
+            stats.count('stat_calls', 2 if include_directories else 1)
+            if include_directories and os.path.isdir(path):
+                yield path
+            elif os.path.isfile(path):
+                if sizes is not None:
+                    stats.count('stat_calls')
+                    sizes[path] = os.path.getsize(path)
+                yield path
+        return
+
+    listed = 0
+    symlinks = 0
+    for entry in scandir(directory):
+        listed += 1
+        if match(entry.name) is None:
+            if subdirectories is not None and entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            continue
+
+        if entry.is_symlink():
+            # The type of the symlink target needs a stat() call
+            symlinks += 1
+
+        if include_directories and entry.is_dir():
+            yield entry.path
+        elif entry.is_file():
+            if sizes is not None:
+                stats.count('stat_calls')
+                sizes[entry.path] = entry.stat().st_size
+            yield entry.path
+
+    stats.count('entries_listed', listed)
+    stats.count('stat_calls', symlinks)
+
+
+def group_series(filenames, parser=parse_filename):
+    """
+    Group backup filenames by series (prefix and postfix around the date)
+
+    Returns a dictionary mapping (prefix, postfix) to a list of filenames.
+    Filenames without a date are ignored.
+    """
+    series = {}
+    for filename in filenames:
+        parsed = parser(filename)
+        if parsed is not None:
+            prefix, _, postfix = parsed
+            series.setdefault((prefix, postfix), []).append(filename)
+
+    return series
+
+
+def parse_shard(filenames, parser=parse_filename):
+    """
+    Parse a chunk of filenames in a worker process (see parse_sharded())
+
+    Returns a list of (series, positions, timestamps, invalid, ordered)
+    with the (prefix, postfix) of each series in the chunk, the positions
+    of its files with a valid date in filenames and their timestamps, the
+    positions of its files with an invalid date, and whether the files
+    are in (timestamp, filename) order.
+    """
+    keys = []
+    positions = []
+    dates = []
+    for position, filename in enumerate(filenames):
+        groups = parser(filename)
+        if groups is not None:
+            prefix, date, postfix = groups
+            keys.append((prefix, postfix))
+            positions.append(position)
+            dates.append(date)
+
+    numpy = get_numpy(len(dates))
+    timestamps = parse_timestamps(dates, numpy) if numpy is not None else None
+    if timestamps is not None:
+        timestamps = timestamps.tolist()
+    else:
+        timestamps = [parse_timestamp(date) for date in dates]
+
+    shards = {}
+    for key, position, timestamp in zip(keys, positions, timestamps):
+        shard = shards.get(key)
+        if shard is None:
+            shard = shards[key] = [key, array.array('l'), array.array('q'),
+                                   array.array('l'), True]
+
+        if timestamp is None or timestamp < 0:
+            shard[3].append(position)
+            continue
+
+        times = shard[2]
+        if shard[4] and times and (timestamp, filenames[position]) < (
+                times[-1], filenames[shard[1][-1]]):
+            shard[4] = False
+        shard[1].append(position)
+        times.append(timestamp)
+
+    return list(shards.values())
+
+
+def parse_sharded(filenames, jobs, parser=parse_filename, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse filenames with parser (parse_filename() or a DateFormat) in jobs
+    worker processes
+
+    Chunks of filenames are parsed by parse_shard(), and the packed results
+    are merged in order. Returns a dictionary mapping (prefix, postfix) to
+    [timestamps, filenames, invalid filenames, ordered] for each series,
+    with filenames in the order they were listed (see PurgeList). With
+    jobs == 1, chunks are parsed in this process (and any parser works).
+    """
+    # Chunks stay in the parent, workers only send back positions in them
+    chunks = []
+
+    def split():
+        iterator = iter(filenames)
+        chunk = list(itertools.islice(iterator, chunk_size))
+        while chunk:
+            chunks.append(chunk)
+            yield chunk
+            chunk = list(itertools.islice(iterator, chunk_size))
+
+    series = {}
+
+    def merge(shards):
+        for number, shard in enumerate(shards):
+            chunk = chunks[number]
+            chunks[number] = None
+            for key, positions, timestamps, invalid, ordered in shard:
+                index = series.get(key)
+                if index is None:
+                    index = series[key] = [array.array('q'), [], [], True]
+
+                times, files = index[0], index[1]
+                if ordered and times and positions and (timestamps[0], chunk[positions[0]]) < (
+                        times[-1], files[-1]):
+                    ordered = False
+                index[3] = index[3] and ordered
+
+                times.extend(timestamps)
+                files.extend(map(chunk.__getitem__, positions))
+                index[2].extend(map(chunk.__getitem__, invalid))
+
+    if jobs <= 1:
+        merge(map(parse_shard, split(), itertools.repeat(parser)))
+        return series
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(jobs) as executor:
+        merge(executor.map(parse_shard, split(), itertools.repeat(parser)))
+
+    return series
+
+
+class PurgeList:
+    def __init__(self, filenames, today, prefix, parser=parse_filename, stats=NO_STATS,
+                 index=None):
+        self.logger = LazyLogger(self.__class__.__name__)
+
+        self.filenames = filenames
+        self.today = today
+        self.prefix = prefix
+        self.parser = parser
+        self.stats = stats
+
+        # Check prefix of files (before date), bail out if not all equal
+        if index is None:
+            self.check_file_list()
+        else:
+            self.load_index(*index)
+
+        # By default, purge everything (maps kept filenames to the reason)
+        self.kept = {}
+
+        # Highest tier (index into TIERS) each kept filename is kept for,
+        # and the bucket (e.g. the month) it is kept for in that tier
+        self.kept_tiers = {}
+        self.kept_buckets = {}
+
+        # Maps kept filenames purged after all (see unkeep()) to the reason
+        self.unkept = {}
+
+    def check_file_list(self):
+        """Parse filenames in a single pass and build the timestamp index"""
+        self.index_times = times = array.array('q')
+        self.index_files = files = []
+        self.invalid_files = invalid = []
+        prefixes = set()
+        postfixes = set()
+        ordered = True
+
+        # Dates are parsed in chunks, so that NumPy can be used for them
+        chunk_files = []
+        chunk_dates = []
+
+        for filename in self.filenames:
+            groups = self.parser(filename)
+            if groups is None:
+                # Ignore all filenames without a date string in them
+                continue
+
+            prefix, date, postfix = groups
+            if self.prefix is not None and prefix != self.prefix:
+                continue
+
+            prefixes.add(prefix)
+            postfixes.add(postfix)
+
+            chunk_files.append(filename)
+            chunk_dates.append(date)
+            if len(chunk_files) == PARSE_CHUNK_SIZE:
+                ordered = self.index_chunk(chunk_files, chunk_dates) and ordered
+                chunk_files = []
+                chunk_dates = []
+
+        ordered = self.index_chunk(chunk_files, chunk_dates) and ordered
+        self.finish_index(ordered, prefixes, postfixes)
+
+    def load_index(self, times, files, invalid, ordered, series):
+        """
+        Use an index of a single series parsed elsewhere (see
+        parse_sharded()), with files in the order they were listed (series
+        is None if there are no backups)
+        """
+        self.index_times = times
+        self.index_files = files
+        self.invalid_files = invalid
+        for filename in invalid:
+            self.logger.debug('Invalid date in filename: %s', filename)
+
+        if series is None:
+            self.finish_index(ordered, set(), set())
+        else:
+            prefix, postfix = series
+            self.finish_index(ordered, set([prefix]), set([postfix]))
+
+    def finish_index(self, ordered, prefixes, postfixes):
+        """Sort the index if not ordered, check that there is only one series"""
+        times = self.index_times
+        files = self.index_files
+        invalid = self.invalid_files
+
+        if not ordered:
+            times, files = self.sort_index()
+
+        self.stats.count('regex_matches', len(files) + len(invalid))
+
+        # Sorted timestamp index used by get_all() and get_first()
+        self.index_times = times
+        self.index_files = files
+        self.filenames = files
+
+        # (prefix, postfix) of the series, used by add()
+        self.series = None
+
+        if not files and not invalid:
+            warn_no_backups('File list is empty')
+            return
+
+        if len(prefixes) != 1:
+            raise MixedFilenames('Non-unique prefixes: {0}'.format(prefixes))
+
+        if len(postfixes) != 1:
+            raise MixedFilenames('Non-unique postfixes: {0}'.format(postfixes))
+
+        self.series = (prefixes.pop(), postfixes.pop())
+
+    def index_chunk(self, filenames, dates):
+        """
+        Parse dates of filenames and append them to the (unsorted) index,
+        returns False if they are not in (timestamp, filename) order
+        """
+        times = self.index_times
+        files = self.index_files
+        ordered = True
+
+        numpy = get_numpy(len(filenames))
+        timestamps = parse_timestamps(dates, numpy) if numpy is not None else None
+        if timestamps is not None:
+            valid = timestamps >= 0
+            if not valid.all():
+                for filename in itertools.compress(filenames, (~valid).tolist()):
+                    self.logger.debug('Invalid date in filename: %s', filename)
+                    self.invalid_files.append(filename)
+                timestamps = timestamps[valid]
+                filenames = list(itertools.compress(filenames, valid.tolist()))
+
+            # Equal timestamps need a comparison of filenames, see sort_index()
+            if len(timestamps) and ((times and timestamps[0] <= times[-1]) or
+                                    not (numpy.diff(timestamps) > 0).all()):
+                ordered = False
+
+            times.frombytes(timestamps.astype(numpy.int64).tobytes())
+            files.extend(filenames)
+            return ordered
+
+        for filename, date in zip(filenames, dates):
+            timestamp = parse_timestamp(date)
+            if timestamp is None:
+                self.logger.debug('Invalid date in filename: %s', filename)
+                self.invalid_files.append(filename)
+                continue
+
+            if ordered and files and (timestamp, filename) < (times[-1], files[-1]):
+                ordered = False
+
+            times.append(timestamp)
+            files.append(filename)
+
+        return ordered
+
+    def sort_index(self):
+        """Get the index sorted by (timestamp, filename)"""
+        times = self.index_times
+        files = self.index_files
+
+        numpy = get_numpy(len(files))
+        if numpy is not None:
+            order = numpy.argsort(numpy.frombuffer(times, dtype=numpy.int64), kind='stable')
+            sorted_times = numpy.frombuffer(times, dtype=numpy.int64)[order]
+            if (numpy.diff(sorted_times) > 0).all():
+                result = array.array('q')
+                result.frombytes(sorted_times.tobytes())
+                return result, [files[i] for i in order.tolist()]
+
+        order = sorted(range(len(files)), key=lambda i: (times[i], files[i]))
+        return array.array('q', [times[i] for i in order]), [files[i] for i in order]
+
+    def add(self, filename):
+        """
+        Add filename to the index of an existing purge list
+
+        Returns True if the files to keep have to be determined again (see
+        reset()), that is, if filename has a new date or sorts before or
+        after all files with the same date (as the first or the last backup
+        of a period can be kept). Otherwise, the new file is to be purged.
+        Raises MixedFilenames if filename does not belong to the series.
+        """
+        groups = self.parser(filename)
+        if groups is None:
+            return False
+
+        prefix, date, postfix = groups
+        if self.prefix is not None and prefix != self.prefix:
+            return False
+
+        if self.series is None:
+            self.series = (prefix, postfix)
+        elif self.series != (prefix, postfix):
+            raise MixedFilenames('Not in series {0}: {1}'.format(self.series, filename))
+
+        timestamp = parse_timestamp(date)
+        if timestamp is None:
+            if filename not in self.invalid_files:
+                self.invalid_files.append(filename)
+            return False
+
+        lo = bisect.bisect_left(self.index_times, timestamp)
+        hi = bisect.bisect_right(self.index_times, timestamp, lo)
+        position = bisect.bisect_left(self.index_files, filename, lo, hi)
+        if position < hi and self.index_files[position] == filename:
+            return False
+
+        self.index_times.insert(position, timestamp)
+        self.index_files.insert(position, filename)
+        return position == lo or position == hi
+
+    def remove(self, filename):
+        """
+        Remove filename from the index, returns True if it was kept (and
+        the files to keep have to be determined again, see reset())
+        """
+        if filename in self.invalid_files:
+            self.invalid_files.remove(filename)
+            return False
+
+        groups = self.parser(filename)
+        timestamp = groups and parse_timestamp(groups[1])
+        if timestamp is None:
+            return False
+
+        lo = bisect.bisect_left(self.index_times, timestamp)
+        hi = bisect.bisect_right(self.index_times, timestamp, lo)
+        position = bisect.bisect_left(self.index_files, filename, lo, hi)
+        if position == hi or self.index_files[position] != filename:
+            return False
+
+        del self.index_times[position]
+        del self.index_files[position]
+        return filename in self.kept
+
+    def reset(self, today=None):
+        """Forget which files to keep (e.g. before applying a policy again)"""
+        if today is not None:
+            self.today = today
+        self.kept = {}
+        self.kept_tiers = {}
+        self.kept_buckets = {}
+        self.unkept = {}
+
+    def keep(self, filename, period, bucket):
+        """
+        Mark filename to be kept for a tier (period, e.g. "monthly") and
+        its bucket key (see bucket_key())
+
+        The reason given in plans is e.g. "monthly (2013-03)" (just "daily"
+        for daily backups).
+        """
+        if filename is None:
+            return
+
+        tier = TIERS.index(period)
+        kind = period if period == 'daily' else '{0} ({1})'.format(period, bucket)
+
+        if filename not in self.kept:
+            self.logger.info('Keeping file for %s: %s', kind, filename)
+            self.kept[filename] = kind
+            self.kept_tiers[filename] = tier
+            self.kept_buckets[filename] = bucket
+        else:
+            self.logger.debug('File for %s already kept: %s', kind, filename)
+            if tier >= self.kept_tiers[filename]:
+                self.kept_tiers[filename] = tier
+                self.kept_buckets[filename] = bucket
+
+    def unkeep(self, filename, reason):
+        """Mark a kept filename to be purged after all"""
+        self.logger.info('Purging file kept for %s (%s): %s', self.kept[filename],
+                         reason, filename)
+        del self.kept[filename]
+        del self.kept_tiers[filename]
+        del self.kept_buckets[filename]
+        self.unkept[filename] = reason
+
+    def kept_entries(self):
+        """
+        Yield (tier, timestamp, filename) for each kept file, tier is the
+        index in TIERS of the highest tier it is kept for (see keep())
+        """
+        for timestamp, filename in zip(self.index_times, self.index_files):
+            tier = self.kept_tiers.get(filename)
+            if tier is not None:
+                yield tier, timestamp, filename
+
+    def get_all(self, year, month=None, day=None, hour=None):
+        """Get all backups for a specific year, month, day or hour"""
+        start, end = date_range(year, month, day, hour)
+
+        lo = bisect.bisect_left(self.index_times, start)
+        hi = bisect.bisect_left(self.index_times, end, lo)
+
+        return self.index_files[lo:hi]
+
+    def get_first(self, year, month=None, day=None, hour=None):
+        """Get first backup for a specific year, month, day or hour
+
+        get_first(2013) -> First available backup in 2013
+        get_first(2013, 3) -> First available backup in March 2013
+        get_first(2013, 3, 31) -> First available backup for March 31st 2013
+        get_first(2013, 3, 31, 8) -> First available backup for 08:00-08:59
+        """
+        start, end = date_range(year, month, day, hour)
+        self.stats.count('lookups')
+
+        lo = bisect.bisect_left(self.index_times, start)
+        if lo < len(self.index_times) and self.index_times[lo] < end:
+            return self.index_files[lo]
+
+        return None
+
+    def get_buckets(self, period, count):
+        """
+        Get (buckets, first) arrays for period (see TIERS), or None if NumPy
+        is not used (see NUMPY_MIN_ENTRIES) or count lookups are cheaper
+        (see BUCKETS_PER_LOOKUP)
+
+        buckets are the sorted numbers (see bucket_of()) of the periods that
+        have backups, first holds the index of the first backup in each.
+        """
+        if count * BUCKETS_PER_LOOKUP < len(self.index_files):
+            return None
+
+        numpy = get_numpy(len(self.index_files))
+        if numpy is None:
+            return None
+
+        times = numpy.frombuffer(self.index_times, dtype=numpy.int64)
+        if period == 'hourly':
+            numbers = times // 3600
+        elif period == 'daily':
+            numbers = times // SECONDS_PER_DAY
+        elif period == 'weekly':
+            numbers = times // (7 * SECONDS_PER_DAY)
+        else:
+            dates = (times // SECONDS_PER_DAY - EPOCH_DAYS).astype('datetime64[D]')
+            if period == 'yearly':
+                numbers = dates.astype('datetime64[Y]').astype(numpy.int64) + 1970
+            else:
+                numbers = dates.astype('datetime64[M]').astype(numpy.int64) + 1970 * 12
+                if period == 'quarterly':
+                    numbers //= 3
+        del times
+
+        # Same as numpy.unique(numbers, return_index=True), as numbers are sorted
+        first = numpy.flatnonzero(numpy.diff(numbers)) + 1
+        first = numpy.concatenate(([0], first)) if len(numbers) else first
+        return numbers[first], first
+
+    def recent_buckets(self, buckets, last, count, pick='first'):
+        """
+        Yield (bucket, filename) for the first (or last) backup in each of
+        the count buckets up to last (see get_buckets()), most recent first
+        """
+        numbers, first = buckets
+        lo = numbers.searchsorted(last - count + 1, 'left')
+        hi = numbers.searchsorted(last, 'right')
+        self.stats.count('lookups', count)
+
+        for i in range(hi - 1, lo - 1, -1):
+            if pick == 'first':
+                index = first[i]
+            else:
+                index = (first[i + 1] if i + 1 < len(first) else len(self.index_files)) - 1
+            yield int(numbers[i]), self.index_files[index]
+
+    def get_today(self):
+        """Timestamp of today (the last hour of it if today is a date)"""
+        timestamp = (self.today.toordinal() - 1) * SECONDS_PER_DAY
+        if isinstance(self.today, datetime.datetime):
+            return timestamp + self.today.hour * 3600
+        return timestamp + 23 * 3600
+
+    def keep_tier(self, tier):
+        """
+        Keep the first (or last) backup in each of the tier.count most
+        recent periods, up to and including the current one
+
+        Only periods with backups are visited: a bisection finds the first
+        backup of the window, and from each backup the next one is found by
+        bisecting for the start of the following period.
+        """
+        if tier.count <= 0:
+            return
+
+        last = bucket_of(tier.period, self.get_today())
+
+        buckets = self.get_buckets(tier.period, tier.count)
+        if buckets is not None:
+            for bucket, filename in self.recent_buckets(buckets, last, tier.count, tier.pick):
+                self.keep(filename, tier.period, bucket_key(tier.period, bucket))
+            return
+
+        times = self.index_times
+        files = self.index_files
+        start = bucket_start(tier.period, last - tier.count + 1)
+        end = bucket_start(tier.period, last + 1)
+
+        position = bisect.bisect_left(times, start)
+        while position < len(times) and times[position] < end:
+            bucket = bucket_of(tier.period, times[position])
+            following = bisect.bisect_left(times, bucket_start(tier.period, bucket + 1),
+                                           position)
+            self.stats.count('lookups')
+
+            index = position if tier.pick == 'first' else following - 1
+            self.keep(files[index], tier.period, bucket_key(tier.period, bucket))
+            position = following
+
+    def keep_hourly(self, hours):
+        self.keep_tier(Tier('hourly', hours))
+
+    def keep_daily(self, days):
+        self.keep_tier(Tier('daily', days))
+
+    def keep_monthly(self, months):
+        self.keep_tier(Tier('monthly', months))
+
+    def keep_yearly(self, years):
+        self.keep_tier(Tier('yearly', years))
+
+    def purged(self):
+        """Yield filenames to purge in date order (invalid dates last)"""
+        for filename in self.index_files:
+            if filename not in self.kept:
+                yield filename
+
+        for filename in self.invalid_files:
+            yield filename
+
+    def get_filenames(self):
+        """Get the set of filenames to purge"""
+        purge = set(filename for filename in self.index_files
+                    if filename not in self.kept)
+        purge.update(self.invalid_files)
+        return purge
+
+    def decisions(self):
+        """
+        Yield (filename, decision, reason) for each file in date order
+
+        decision is 'keep' or 'purge', reason is the tier a kept file is kept
+        for (None for purged files). Files with an invalid date come last.
+        """
+        for filename in self.index_files:
+            reason = self.kept.get(filename)
+            if reason is None:
+                yield filename, 'purge', None
+            else:
+                yield filename, 'keep', reason
+
+        for filename in self.invalid_files:
+            yield filename, 'purge', None
+
+    def plan_entries(self):
+        """
+        Yield a dict for each file in date order (see PLAN_FIELDS)
+
+        Entries are generated from the timestamp index, files with an
+        invalid date come last (with date None).
+        """
+        epoch = datetime.datetime(datetime.MINYEAR, 1, 1)
+        for timestamp, filename in zip(self.index_times, self.index_files):
+            tier = self.kept_tiers.get(filename)
+            entry = {
+                'path': filename,
+                'date': (epoch + datetime.timedelta(seconds=timestamp)).isoformat(),
+            }
+            if tier is None:
+                entry.update(decision='purge', tier=None, bucket=None,
+                             reason=self.unkept.get(filename))
+            else:
+                entry.update(decision='keep', tier=TIERS[tier],
+                             bucket=self.kept_buckets[filename], reason=self.kept[filename])
+            yield entry
+
+        for filename in self.invalid_files:
+            yield {'path': filename, 'date': None, 'decision': 'purge', 'tier': None,
+                   'bucket': None, 'reason': 'invalid date'}
+
+
+# Columns of a plan written by write_plan()
+PLAN_FIELDS = ('path', 'decision', 'tier', 'bucket', 'date', 'reason')
+
+
+def write_plan(purge_lists, format, stream):
+    """
+    Write the plan for purge_lists to a text stream, one line per file,
+    format is 'jsonl' (JSON Lines) or 'csv' (with a header, see PLAN_FIELDS)
+    """
+    if format == 'jsonl':
+        import json
+        for purge_list in purge_lists:
+            for entry in purge_list.plan_entries():
+                stream.write(json.dumps(entry, sort_keys=True))
+                stream.write('\n')
+    elif format == 'csv':
+        import csv
+        writer = csv.DictWriter(stream, PLAN_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        for purge_list in purge_lists:
+            writer.writerows(purge_list.plan_entries())
+    else:
+        raise ValueError('Unknown plan format: {0}'.format(format))
+
+
+def save_plan(purge_lists, filename):
+    """
+    Save the plan for purge_lists to filename for apply_plan()
+
+    The plan is written as JSON Lines (see write_plan()) with absolute
+    paths, and the inode, size and modification time of each backup to
+    purge (which needs one lstat() call for each of them).
+    """
+    import json
+
+    logger = LazyLogger('save_plan')
+
+    # Write atomically, a partial plan must never be applied
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        for purge_list in purge_lists:
+            for entry in purge_list.plan_entries():
+                entry['path'] = os.path.abspath(entry['path'])
+                if entry['decision'] == 'purge':
+                    try:
+                        st = os.lstat(entry['path'])
+                        entry.update(inode=st.st_ino, size=st.st_size, mtime=st.st_mtime)
+                    except OSError as e:
+                        # Without inode, size and mtime, it won't be deleted
+                        logger.warning('Could not stat %s: %s', entry['path'], e)
+
+                fp.write(json.dumps(entry, sort_keys=True))
+                fp.write('\n')
+    os.rename(tmp_filename, filename)
+
+
+def apply_plan(filename, deleter, batch_size=1000, journal_file=None):
+    """
+    Delete the backups to purge in a plan saved by save_plan()
+
+    Retention is not evaluated again, but each backup is only deleted if
+    its inode, size and modification time are still those in the plan.
+    Deletions are done in batches, and the number of plan lines done is
+    appended to a journal (default: filename + '.journal') after each
+    batch, so that an interrupted run continues after the last complete
+    batch. Applying a plan again does nothing.
+
+    Returns (changed, missing), the number of backups skipped because they
+    changed since the plan was saved, or were gone already.
+    """
+    import errno
+    import json
+
+    logger = LazyLogger('apply_plan')
+    if journal_file is None:
+        journal_file = filename + '.journal'
+
+    # The journal is only valid for the very same plan file
+    st = os.stat(filename)
+    identity = 'plan {0} {1!r}'.format(st.st_size, st.st_mtime)
+
+    done = 0
+    try:
+        with open(journal_file) as fp:
+            lines = fp.read().split('\n')
+        if lines[0] == identity:
+            # The last line is incomplete (or empty)
+            done = max([int(line) for line in lines[1:-1] if line.isdigit()] or [0])
+            logger.info('Resuming %s after line %d', filename, done)
+    except (IOError, OSError):
+        pass
+
+    changed = 0
+    missing = 0
+
+    def verify(entry):
+        try:
+            st = os.lstat(entry['path'])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.info('Already gone: %s', entry['path'])
+            return 'missing'
+
+        if (st.st_ino, st.st_size, st.st_mtime) != (entry.get('inode'), entry.get('size'),
+                                                   entry.get('mtime')):
+            logger.warning('Changed since the plan was saved, not deleting: %s',
+                           entry['path'])
+            return 'changed'
+
+        return None
+
+    with open(journal_file, 'a' if done else 'w') as journal:
+        if not done:
+            journal.write(identity + '\n')
+
+        def commit(batch, number):
+            deleter.delete(batch)
+            journal.write('{0}\n'.format(number))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        batch = []
+        number = done
+        with open(filename) as fp:
+            for number, line in enumerate(fp, 1):
+                if number <= done:
+                    continue
+
+                entry = json.loads(line)
+                if entry['decision'] != 'purge':
+                    continue
+
+                try:
+                    result = verify(entry)
+                except OSError as e:
+                    logger.error('Could not check %s: %s', entry['path'], e)
+                    result = 'changed'
+
+                if result == 'changed':
+                    changed += 1
+                elif result == 'missing':
+                    missing += 1
+                else:
+                    batch.append(entry['path'])
+                    if len(batch) == batch_size:
+                        commit(batch, number)
+                        batch = []
+
+        if number > done:
+            commit(batch, number)
+
+    return changed, missing
+
+
+def plan(filenames, today, policy, prefix=None, parser=parse_filename):
+    """
+    Plan which backups to keep and which to purge
+
+    filenames can be any iterable (e.g. a generator over a listing), it is
+    consumed exactly once and only the timestamp index is kept in memory.
+    Yields (filename, decision, reason) tuples as PurgeList.decisions().
+    """
+    purge_list = PurgeList(filenames, today, prefix, parser)
+    policy.apply(purge_list)
+
+    for decision in purge_list.decisions():
+        yield decision
+
+
+class ScanCache:
+    """
+    On-disk cache of directory listings and parsed backup filenames
+
+    For each directory, the (prefix, date, postfix) split of every backup
+    name is stored together with the directory modification time, in a JSON
+    file below $XDG_CACHE_HOME/backuppurge/. If the directory has not been
+    modified since, its listing is taken from the cache. Otherwise, the
+    directory is listed again, entries that are gone are dropped and only
+    names not seen before are parsed.
+
+    If sizes are needed (see find_backups()), the size of each backup file
+    is stored with its entry, unless the file was modified right before the
+    scan (as it may still be written).
+    """
+    VERSION = 4
+
+    # Modification times closer to the scan than this are not trusted, as
+    # changes within the timestamp granularity would go unnoticed
+    MTIME_SLACK = 2
+
+    def __init__(self, cache_dir=None, stats=NO_STATS):
+        self.logger = LazyLogger(self.__class__.__name__)
+        self.stats = stats
+
+        if cache_dir is None:
+            cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+            cache_dir = os.path.join(cache_home, 'backuppurge')
+
+        self.cache_dir = cache_dir
+        self.parsed = {}
+
+    def get_cache_file(self, directory, include_directories):
+        import hashlib
+        key = '{0}\0{1}'.format(os.path.abspath(directory), int(include_directories))
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, cache_file):
+        import json
+        try:
+            with open(cache_file) as fp:
+                cached = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if not isinstance(cached, dict) or cached.get('version') != self.VERSION:
+            return {}
+
+        return cached
+
+    def save(self, cache_file, cached):
+        import json
+        import threading
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            tmp_file = '{0}.{1}.tmp'.format(cache_file, threading.current_thread().ident)
+            with open(tmp_file, 'w') as fp:
+                json.dump(cached, fp)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            self.logger.warning('Could not write cache file %s: %s', cache_file, e)
+
+    def scan(self, directory, include_directories, entries, with_sizes, started):
+        """
+        List directory, reusing parsed entries, return (entries,
+        subdirectories), entries are [prefix, date, postfix, size] (size
+        is None for directories and if unknown)
+        """
+        if scandir is None:
+            names = [os.path.basename(path) for path in
+                     find_backups(directory, include_directories, stats=self.stats)]
+            return dict((name, (entries.get(name) or parse_filename(name))[:3] + (None,))
+                        for name in names), None
+
+        new_entries = {}
+        subdirectories = []
+        listed = 0
+        for entry in scandir(directory):
+            listed += 1
+            parsed = entries.get(entry.name)
+            if parsed is None:
+                parsed = parse_filename(entry.name)
+                if parsed is None:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+                    continue
+                parsed += (None,)
+
+            if include_directories and entry.is_dir():
+                new_entries[entry.name] = parsed[:3] + (None,)
+            elif entry.is_file():
+                if with_sizes:
+                    self.stats.count('stat_calls')
+                    st = entry.stat()
+                    size = st.st_size if started - st.st_mtime > self.MTIME_SLACK else None
+                    parsed = parsed[:3] + (size,)
+                new_entries[entry.name] = parsed
+
+        self.stats.count('entries_listed', listed)
+        return new_entries, subdirectories
+
+    def find_backups(self, directory, include_directories, subdirectories=None, sizes=None):
+        """
+        Find backup files in directory (see find_backups()) using the cache
+
+        Parsed filenames are remembered for parse(), so they can be passed
+        to PurgeList with parser=cache.parse. If sizes is a dictionary, the
+        known sizes of backup files are stored in it.
+        """
+        cache_file = self.get_cache_file(directory, include_directories)
+        cached = self.load(cache_file)
+
+        started = time.time()
+        st = os.stat(directory)
+        self.stats.count('stat_calls')
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+
+        # JSON has lists, (prefix, date, postfix, size) is needed
+        entries = dict((name, tuple(entry))
+                       for name, entry in cached.get('entries', {}).items())
+        cached_subdirectories = cached.get('subdirectories')
+        if (cached.get('mtime') != mtime or
+                (subdirectories is not None and cached_subdirectories is None)):
+            self.logger.debug('Directory changed, rescanning: %s', directory)
+            entries, cached_subdirectories = self.scan(directory, include_directories,
+                                                       entries, sizes is not None, started)
+            self.save(cache_file, {
+                'version': self.VERSION,
+                'directory': os.path.abspath(directory),
+                'mtime': mtime if started - st.st_mtime > self.MTIME_SLACK else None,
+                'entries': entries,
+                'subdirectories': cached_subdirectories,
+            })
+
+        if subdirectories is not None:
+            if cached_subdirectories is None:
+                # No os.scandir(): fall back to a regular scan
+                list(find_backups(directory, include_directories, subdirectories,
+                                  self.stats))
+            else:
+                subdirectories.extend(os.path.join(directory, name)
+                                      for name in cached_subdirectories)
+
+        filenames = []
+        parsed = {}
+        for name, (prefix, date, postfix, size) in entries.items():
+            filename = os.path.join(directory, name)
+            parsed[filename] = (filename[:-len(name)] + prefix, date, postfix)
+            filenames.append(filename)
+            if sizes is not None and size is not None:
+                sizes[filename] = size
+
+        self.parsed.update(parsed)
+        return filenames
+
+    def parse(self, filename):
+        """Like parse_filename(), but using parsed names from the cache"""
+        parsed = self.parsed.get(filename)
+        if parsed is None:
+            return parse_filename(filename)
+
+        return parsed
+
+
+def disk_usage(paths, threads=8):
+    """
+    Get a dictionary mapping paths of files and directory trees to their
+    size in bytes, walking directories concurrently on a pool of threads
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    logger = LazyLogger('disk_usage')
+
+    def usage(path):
+        try:
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                return tree_usage(path)[0]
+            return st.st_size
+        except OSError as e:
+            logger.warning('Could not get size of %s: %s', path, e)
+            return 0
+
+    with ThreadPoolExecutor(threads) as executor:
+        return dict(zip(paths, executor.map(usage, paths)))
+
+
+def enforce_size_budget(purge_lists, max_total_size, sizes, stats=NO_STATS):
+    """
+    Purge kept files of all purge_lists until the total size of the kept
+    files is at most max_total_size bytes
+
+    Files are purged lowest tier first (see TIERS), and oldest first within
+    a tier. Sizes of kept files missing from sizes are added to it (one
+    lstat() per file, and a walk of each directory).
+    """
+    import heapq
+
+    heap = []
+    for purge_list in purge_lists:
+        heap.extend((tier, timestamp, filename, purge_list)
+                    for tier, timestamp, filename in purge_list.kept_entries())
+
+    missing = [filename for _, _, filename, _ in heap if filename not in sizes]
+    if missing:
+        stats.count('stat_calls', len(missing))
+        sizes.update(disk_usage(missing))
+
+    total_size = sum(sizes[filename] for _, _, filename, _ in heap)
+    heapq.heapify(heap)
+
+    while total_size > max_total_size and heap:
+        _, _, filename, purge_list = heapq.heappop(heap)
+        purge_list.unkeep(filename, 'over size budget')
+        total_size -= sizes[filename]
+
+
+def purge_filenames(filenames, today, policy, prefix, all_series, parser=parse_filename,
+                    stats=NO_STATS, sizes=None, jobs=1):
+    """
+    Get the list of backups to purge from a list of filenames, in date
+    order (series by series, with all_series)
+
+    See get_purge_lists() for the arguments.
+    """
+    purge_files = []
+    for purge_list in get_purge_lists(filenames, today, policy, prefix, all_series,
+                                      parser, stats, sizes, jobs):
+        count = len(purge_files)
+        purge_files.extend(purge_list.purged())
+        stats.count('kept', len(purge_list.kept))
+        stats.count('purged', len(purge_files) - count)
+
+    return purge_files
+
+
+def get_purge_lists(filenames, today, policy, prefix, all_series, parser=parse_filename,
+                    stats=NO_STATS, sizes=None, jobs=1):
+    """
+    Get a list of PurgeList objects (one for each series with all_series)
+    with the policy applied, from a list of filenames
+
+    If stats are enabled, filenames are listed completely before parsing
+    starts, so that the time spent in each phase can be told apart. If the
+    policy has a size budget, sizes should map filenames to their size as
+    collected while listing (missing sizes are looked up). With jobs > 1,
+    filenames are parsed in that many processes (only with parse_filename()
+    or a DateFormat as parser, see parse_sharded()).
+    """
+    if stats.enabled:
+        with stats.phase('list'):
+            filenames = list(filenames)
+
+    if not (parser is parse_filename or isinstance(parser, DateFormat)):
+        jobs = 1
+
+    if jobs > 1 or all_series:
+        # With all_series, each filename is parsed once while grouping, and
+        # the index of each series is passed to its PurgeList
+        return get_purge_lists_sharded(filenames, today, policy, prefix, all_series, stats,
+                                       sizes, jobs, parser)
+
+    with stats.phase('parse'):
+        purge_list = PurgeList(filenames, today, prefix, parser, stats)
+
+    return apply_policy([purge_list], policy, stats, sizes)
+
+
+def get_purge_lists_sharded(filenames, today, policy, prefix, all_series, stats, sizes,
+                            jobs, parser=parse_filename):
+    """
+    Like get_purge_lists(), but parsing in chunks, in jobs processes (see
+    parse_sharded()), with the same result
+    """
+    with stats.phase('parse'):
+        series = parse_sharded(filenames, jobs, parser)
+        keys = sorted(key for key in series if prefix is None or key[0] == prefix)
+
+        if not all_series and len(keys) > 1:
+            # Raise the same error as PurgeList
+            prefixes = set(series_prefix for series_prefix, _ in keys)
+            if len(prefixes) != 1:
+                raise MixedFilenames('Non-unique prefixes: {0}'.format(prefixes))
+            raise MixedFilenames('Non-unique postfixes: {0}'.format(
+                                 set(postfix for _, postfix in keys)))
+
+        if not keys:
+            if all_series:
+                warn_no_backups('File list is empty')
+            else:
+                # Empty PurgeList, which warns
+                keys = [None]
+
+        purge_lists = []
+        for key in keys:
+            times, files, invalid, ordered = series[key] if key is not None else (
+                    array.array('q'), [], [], True)
+            purge_lists.append(PurgeList(files, today, None if all_series else prefix,
+                                         parser, stats,
+                                         index=(times, files, invalid, ordered, key)))
+
+    return apply_policy(purge_lists, policy, stats, sizes)
+
+
+def apply_policy(purge_lists, policy, stats=NO_STATS, sizes=None):
+    """
+    Apply policy to purge_lists (including the size budget, see
+    get_purge_lists()), returns purge_lists
+    """
+    for purge_list in purge_lists:
+        with stats.phase('keep'):
+            policy.apply(purge_list)
+
+    if policy.max_total_size is not None:
+        with stats.phase('size'):
+            enforce_size_budget(purge_lists, policy.max_total_size,
+                                {} if sizes is None else sizes, stats)
+
+    return purge_lists
+
+
+# Columns of a simulation report written by run() (see simulate())
+SIMULATION_FIELDS = ('date', 'kept', 'purged', 'kept_size', 'purged_size')
+
+
+class TierWindow:
+    """
+    Backups kept for a tier (see Tier) by consecutive daily runs, updated
+    as the days advance and new backups appear (see simulate())
+
+    A backup kept for a period is not purged until the period leaves the
+    window, so the first backup of a period never changes afterwards, and
+    the last one only changes when a newer backup appears.
+    """
+    def __init__(self, tier):
+        self.tier = tier
+
+        # (bucket, filename) for each period with a backup, oldest first
+        self.kept = collections.deque()
+
+    def advance(self, first, released):
+        """Forget periods before bucket first, adding their backups to released"""
+        kept = self.kept
+        while kept and kept[0][0] < first:
+            released.append(kept.popleft()[1])
+
+    def add(self, bucket, filename, released):
+        """Offer a new backup in bucket, returns True if it is kept"""
+        kept = self.kept
+        if kept and kept[-1][0] == bucket:
+            if self.tier.pick == 'first':
+                return False
+            released.append(kept.pop()[1])
+
+        kept.append((bucket, filename))
+        return True
+
+
+def simulate(filenames, today, days, policy, prefix, all_series, parser=parse_filename,
+             stats=NO_STATS, sizes=None, jobs=1):
+    """
+    Replay daily runs of policy over a list of filenames, yielding a dict
+    for each day (see SIMULATION_FIELDS)
+
+    Runs happen on days consecutive days starting at today (a date). A
+    backup appears on its date and is gone
+    once a run purged it. The index of each series is built once, backups
+    appearing on a day are taken from it with a bisection, and the windows
+    of the tiers are moved along (see TierWindow), so each day only costs
+    as much as the backups that appear or leave a window. purged and
+    purged_size are for the backups purged by that day's run, sizes maps
+    filenames to their size (missing sizes count as 0).
+    """
+    sizes = {} if sizes is None else sizes
+
+    # Parse and index only, the policy is applied day by day below
+    purge_lists = get_purge_lists(filenames, today, Policy(tiers=[]), prefix, all_series,
+                                  parser, stats, jobs=jobs)
+    if policy.max_total_size is not None:
+        return simulate_runs(purge_lists, today, days, policy, sizes)
+
+    return simulate_windows(purge_lists, today, days, policy, sizes)
+
+
+def simulate_windows(purge_lists, today, days, policy, sizes):
+    """Replay runs for simulate() by moving the windows of the tiers"""
+    tiers = [tier for tier in policy.get_tiers() if tier.count > 0]
+
+    # (index, windows, position of the first backup yet to appear)
+    series = [[purge_list.index_times, purge_list.index_files,
+               [TierWindow(tier) for tier in tiers], 0] for purge_list in purge_lists]
+
+    # Number of tiers keeping each backup
+    refs = {}
+    kept_size = 0
+
+    # Files with invalid dates are purged by the first run
+    invalid = [filename for purge_list in purge_lists
+               for filename in purge_list.invalid_files]
+
+    for offset in range(days):
+        date = today + datetime.timedelta(days=offset)
+        end = date.toordinal() * SECONDS_PER_DAY
+
+        # Runs on a date see the last hour of it (see PurgeList.get_today())
+        now = end - SECONDS_PER_DAY + 23 * 3600
+        firsts = [bucket_of(tier.period, now) - tier.count + 1 for tier in tiers]
+
+        candidates = set()
+        released = []
+        for state in series:
+            times, files, windows, position = state
+            for window, first in zip(windows, firsts):
+                window.advance(first, released)
+
+            following = bisect.bisect_left(times, end, position)
+            for index in range(position, following):
+                filename = files[index]
+                candidates.add(filename)
+                kept_size += sizes.get(filename, 0)
+                for window, first in zip(windows, firsts):
+                    bucket = bucket_of(window.tier.period, times[index])
+                    if bucket >= first and window.add(bucket, filename, released):
+                        refs[filename] = refs.get(filename, 0) + 1
+            state[3] = following
+
+        for filename in released:
+            refs[filename] -= 1
+        candidates.update(released)
+
+        purged = [filename for filename in candidates if not refs.get(filename)]
+        for filename in purged:
+            refs.pop(filename, None)
+
+        purged_size = sum(sizes.get(filename, 0) for filename in purged)
+        kept_size -= purged_size
+        purged.extend(invalid)
+        purged_size += sum(sizes.get(filename, 0) for filename in invalid)
+        invalid = []
+
+        yield {
+            'date': date.strftime('%Y-%m-%d'),
+            'kept': len(refs),
+            'purged': len(purged),
+            'kept_size': kept_size,
+            'purged_size': purged_size,
+        }
+
+
+def simulate_runs(purge_lists, today, days, policy, sizes):
+    """
+    Replay runs for simulate() by applying the policy to the backups kept
+    by the previous run and the new ones, needed for a size budget
+    """
+    # (purge list, full index, position of the first backup yet to appear)
+    series = []
+    for purge_list in purge_lists:
+        series.append([purge_list, purge_list.index_times, purge_list.index_files, 0])
+        purge_list.index_times = array.array('q')
+        purge_list.index_files = []
+
+    # Sizes for enforce_size_budget(), which would look up missing ones
+    budget_sizes = dict((filename, sizes.get(filename, 0))
+                        for _, _, files, _ in series for filename in files)
+
+    # Files with invalid dates are purged by the first run
+    invalid = [filename for purge_list in purge_lists
+               for filename in purge_list.invalid_files]
+
+    for offset in range(days):
+        date = today + datetime.timedelta(days=offset)
+        end = date.toordinal() * SECONDS_PER_DAY
+
+        for state in series:
+            purge_list, times, files, position = state
+            following = bisect.bisect_left(times, end, position)
+            purge_list.index_times.extend(times[position:following])
+            purge_list.index_files.extend(files[position:following])
+            state[3] = following
+
+            purge_list.reset(date)
+            policy.apply(purge_list)
+
+        enforce_size_budget(purge_lists, policy.max_total_size, budget_sizes)
+
+        purged = invalid
+        invalid = []
+        kept_size = 0
+        for purge_list, _, _, _ in series:
+            kept = purge_list.kept
+            times = array.array('q')
+            files = []
+            for timestamp, filename in zip(purge_list.index_times, purge_list.index_files):
+                if filename in kept:
+                    times.append(timestamp)
+                    files.append(filename)
+                    kept_size += sizes.get(filename, 0)
+                else:
+                    purged.append(filename)
+
+            purge_list.index_times = times
+            purge_list.index_files = files
+
+        yield {
+            'date': date.strftime('%Y-%m-%d'),
+            'kept': sum(len(purge_list.index_files) for purge_list in purge_lists),
+            'purged': len(purged),
+            'kept_size': kept_size,
+            'purged_size': sum(sizes.get(filename, 0) for filename in purged),
+        }
+
+
+def purge_directory(directory, today, policy, include_directories, prefix, all_series,
+                    subdirectories=None, cache=None, stats=NO_STATS, parser=parse_filename):
+    """
+    Get the list of backups to purge in a single directory (see
+    purge_filenames())
+
+    If subdirectories is a list, subdirectories found while scanning are
+    appended to it and a directory without backups is not an error. If
+    cache is a ScanCache, the directory listing is taken from it.
+    """
+    sizes = {} if policy.max_total_size is not None else None
+    backend = LocalBackend(directory, include_directories, cache, stats, sizes, parser)
+    filenames = backend.list(subdirectories)
+
+    if subdirectories is not None:
+        with stats.phase('list'):
+            filenames = list(filenames)
+        if not filenames:
+            return []
+
+    return purge_filenames(filenames, today, policy, prefix, all_series, backend.parse,
+                           stats, sizes)
+
+
+def purge_tree(directory, today, policy, include_directories, prefix, all_series,
+               max_depth=None, threads=8, cache=None, stats=NO_STATS, parser=parse_filename):
+    """
+    Recursively purge directory, yielding (directory, purge list) pairs
+
+    Every directory below directory (up to max_depth levels deep) is treated
+    as a separate backup location, not only leaf directories: backups next
+    to subdirectories (e.g. in /backups/<host>/ besides /backups/<host>/etc/)
+    are a series of their own, directories without backups yield an empty
+    list. Directories are scanned and evaluated concurrently on a pool of
+    threads, and results are yielded as soon as each directory is done, in
+    no particular order. Directories with a date in their name are backups
+    themselves and are never descended into.
+
+    A directory that cannot be purged (e.g. with more than one series and
+    without all_series) yields None instead of a list, its subdirectories
+    are still purged.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    logger = LazyLogger('purge_tree')
+
+    def scan(directory, depth):
+        subdirectories = []
+        try:
+            purge_files = purge_directory(directory, today, policy,
+                                          include_directories, prefix, all_series,
+                                          subdirectories, cache, stats, parser)
+        except (OSError, MixedFilenames) as e:
+            logger.error('Skipping %s: %s', directory, e)
+            return directory, depth, None, subdirectories
+
+        return directory, depth, purge_files, subdirectories
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = {executor.submit(scan, directory, 0)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory, depth, purge_files, subdirectories = future.result()
+                if max_depth is None or depth < max_depth:
+                    pending.update(executor.submit(scan, subdirectory, depth + 1)
+                                   for subdirectory in subdirectories)
+                yield directory, purge_files
+
+
+def purge_locations(locations, today, include_directories, prefix, all_series,
+                    threads=8, per_device=2, cache=None, stats=NO_STATS,
+                    parser=parse_filename):
+    """
+    Purge multiple directories, yielding (directory, purge list) pairs
+
+    locations is a list of (directory, policy) pairs. Directories are purged
+    concurrently on a pool of threads, but at most per_device of them on the
+    same device (filesystem) at a time. Results are yielded as soon as each
+    directory is done, in no particular order.
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    logger = LazyLogger('purge_locations')
+    lock = threading.Lock()
+    semaphores = {}
+
+    def purge(directory, policy):
+        try:
+            device = os.stat(directory).st_dev
+            with lock:
+                semaphore = semaphores.setdefault(device, threading.Semaphore(per_device))
+
+            with semaphore:
+                return directory, purge_directory(directory, today, policy,
+                                                  include_directories, prefix,
+                                                  all_series, cache=cache, stats=stats,
+                                                  parser=parser)
+        except (OSError, MixedFilenames) as e:
+            logger.error('Skipping %s: %s', directory, e)
+            return directory, []
+
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(purge, directory, policy)
+                   for directory, policy in locations]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class InotifyWatcher:
+    """
+    Watch a directory for new, moved and deleted entries using inotify(7)
+    (Linux only, via ctypes), files are reported as created again when
+    they are closed after writing
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+
+    EVENT_HEADER = 'iIII'
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+        import struct
+
+        self.header = struct.Struct(self.EVENT_HEADER)
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        mask = (self.IN_CREATE | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_DELETE |
+                self.IN_MOVED_FROM)
+        path = directory.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), directory)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for changes, return a list of (name,
+        created) pairs, or None if events were lost (rescan needed)
+        """
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                # EAGAIN: all pending events read
+                return changes
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = self.header.unpack_from(data, offset)
+                offset += self.header.size
+                name = fsdecode(data[offset:offset+length].rstrip(b'\0'))
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+
+                changes.append((name, bool(mask & (self.IN_CREATE | self.IN_CLOSE_WRITE |
+                                                   self.IN_MOVED_TO))))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watch a directory by listing it every interval seconds (for platforms
+    without inotify)
+    """
+    def __init__(self, directory, interval=60):
+        self.directory = directory
+        self.interval = interval
+        self.names = set(os.listdir(directory))
+
+    def wait(self, timeout):
+        """See InotifyWatcher.wait()"""
+        time.sleep(max(0, min(timeout, self.interval)))
+
+        names = set(os.listdir(self.directory))
+        changes = ([(name, True) for name in names - self.names] +
+                   [(name, False) for name in self.names - names])
+        self.names = names
+        return changes
+
+    def close(self):
+        pass
+
+
+def get_watcher(directory, interval=60):
+    """Watch directory with inotify if possible, by polling otherwise"""
+    try:
+        return InotifyWatcher(directory)
+    except (OSError, AttributeError) as e:
+        LazyLogger('get_watcher').debug('Polling %s, inotify not available: %s',
+                                        directory, e)
+        return PollingWatcher(directory, interval)
+
+
+def watch(directory, policy, include_directories, prefix, all_series, watcher=None,
+          interval=60, now=datetime.datetime.now, parser=parse_filename):
+    """
+    Purge directory whenever new backups arrive, yielding lists of backups
+    that have become purgeable (in date order)
+
+    The directory is listed and indexed once, later changes reported by
+    watcher (see get_watcher()) are applied to the index incrementally. The
+    policy is applied again only if a new date appears, a kept backup is
+    removed or the day (the hour with hourly backups) rolls over, and every
+    purgeable backup is yielded only once.
+    """
+    logger = LazyLogger('watch')
+    if watcher is None:
+        watcher = get_watcher(directory, interval)
+
+    def series_key(filename):
+        if not all_series:
+            return None
+        groups = parser(filename)
+        if groups is None or (prefix is not None and groups[0] != prefix):
+            return False
+        return (groups[0], groups[2])
+
+    def scan():
+        purge_lists = {} if all_series else {None: []}
+        for filename in find_backups(directory, include_directories, parser=parser):
+            key = series_key(filename)
+            if key is not False:
+                purge_lists.setdefault(key, []).append(filename)
+
+        return dict((key, PurgeList(filenames, today, None if all_series else prefix,
+                                    parser))
+                    for key, filenames in purge_lists.items())
+
+    def is_backup(filename):
+        try:
+            mode = os.stat(filename).st_mode
+        except OSError:
+            return False
+        return stat.S_ISREG(mode) or (include_directories and stat.S_ISDIR(mode))
+
+    hourly = any(tier.period == 'hourly' and tier.count > 0 for tier in policy.get_tiers())
+
+    def period(today):
+        return today.replace(minute=0, second=0, microsecond=0) if hourly else today.date()
+
+    today = now()
+    purge_lists = scan()
+    changed = set(purge_lists)
+    emitted = set()
+    sizes = {}
+
+    try:
+        while True:
+            if period(now()) != period(today):
+                today = now()
+                changed = set(purge_lists)
+
+            if changed and policy.max_total_size is not None:
+                # The total size changes with any new or removed file
+                changed = set(purge_lists)
+
+            for key in changed:
+                purge_lists[key].reset(today)
+                policy.apply(purge_lists[key])
+
+            if changed and policy.max_total_size is not None:
+                enforce_size_budget(purge_lists.values(), policy.max_total_size, sizes)
+            changed = set()
+
+            purge_files = [filename for _, purge_list in sorted(purge_lists.items())
+                           for filename in purge_list.purged()]
+
+            new_files = [filename for filename in purge_files if filename not in emitted]
+            emitted.intersection_update(purge_files)
+            if new_files:
+                emitted.update(new_files)
+                yield new_files
+
+            # Wake up in time for the next day (or hour) to begin
+            if hourly:
+                rollover = period(today) + datetime.timedelta(hours=1)
+            else:
+                rollover = datetime.datetime.combine(period(today) + datetime.timedelta(days=1),
+                                                     datetime.time())
+            timeout = max(1, min(interval, (rollover - now()).total_seconds()))
+
+            changes = watcher.wait(timeout)
+            if changes is None:
+                logger.warning('Events lost, rescanning %s', directory)
+                purge_lists = scan()
+                changed = set(purge_lists)
+                continue
+
+            for name, created in changes:
+                filename = os.path.join(directory, name)
+                key = series_key(filename)
+                if key is False:
+                    continue
+
+                # Size of a new file may have been looked up while it was written
+                sizes.pop(filename, None)
+
+                if not created:
+                    if key in purge_lists and purge_lists[key].remove(filename):
+                        changed.add(key)
+                    continue
+
+                if not is_backup(filename):
+                    continue
+
+                if key not in purge_lists:
+                    # First backup of a new series (with all_series)
+                    purge_lists[key] = PurgeList([filename], today, None, parser)
+                    changed.add(key)
+                    continue
+
+                try:
+                    if purge_lists[key].add(filename):
+                        changed.add(key)
+                    elif policy.max_total_size is not None:
+                        changed.add(key)
+                except MixedFilenames as e:
+                    logger.warning('Ignoring %s: %s', filename, e)
+    finally:
+        watcher.close()
+
+
+def write_filenames(filenames, separator, stream=None, chunk_size=OUTPUT_CHUNK_SIZE):
+    """
+    Write filenames to a binary stream (default: stdout), each followed by
+    separator
+
+    Filenames are encoded and collected in a buffer that is written and
+    flushed every chunk_size bytes, so that a consumer (e.g. xargs) can
+    start working on the first chunk while the rest is written.
+    """
+    if stream is None:
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    separator = fsencode(separator)
+    buffer = bytearray()
+    for filename in filenames:
+        buffer += fsencode(filename)
+        buffer += separator
+        if len(buffer) >= chunk_size:
+            stream.write(buffer)
+            stream.flush()
+            del buffer[:]
+
+    if buffer:
+        stream.write(buffer)
+    stream.flush()
+
+
+def load_config(filename, default_policy):
+    """
+    Load a list of (directory, policy) pairs from an INI-style config file
+
+    Each section is a directory. The options days, months, years, hours,
+    tiers (see parse_tiers()) and max-total-size override those of
+    default_policy for that directory, and can also be given for all
+    directories in a [DEFAULT] section.
+    """
+    from configparser import RawConfigParser
+
+    parser = RawConfigParser()
+    with open(filename) as fp:
+        getattr(parser, 'read_file', getattr(parser, 'readfp', None))(fp)
+
+    locations = []
+    for section in parser.sections():
+        def get(option, default, type=int):
+            if not parser.has_option(section, option):
+                return default
+            return type(parser.get(section, option))
+
+        policy = Policy(get('days', default_policy.days),
+                        get('months', default_policy.months),
+                        get('years', default_policy.years),
+                        get('hours', default_policy.hours),
+                        get('max-total-size', default_policy.max_total_size, parse_size),
+                        get('tiers', default_policy.tiers, parse_tiers))
+        locations.append((section, policy))
+
+    return locations
+
+
+def set_io_priority(io_class, level=4):
+    """
+    Set the I/O scheduling class (see IOPRIO_CLASSES) and level (0-7, not
+    used for idle) of the calling thread with ioprio_set(2), threads
+    started afterwards inherit it (Linux only, via ctypes)
+    """
+    import ctypes
+    import ctypes.util
+    import errno
+    import platform
+
+    number = IOPRIO_SET.get(platform.machine())
+    if not sys.platform.startswith('linux') or number is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set() is not supported on this platform')
+
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASS_SHIFT = 13
+    priority = IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT
+    if io_class != 'idle':
+        priority |= level
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, priority) < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+class TokenBucket:
+    """
+    Token bucket for rate units per second on average, with bursts of up
+    to capacity units (default: one second worth)
+
+    take() blocks until the tokens are available. Taking more than the
+    capacity at once is allowed, it is paid back by waiting longer.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        import threading
+        self.rate = float(rate)
+        self.capacity = self.rate if capacity is None else capacity
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def take(self, amount=1):
+        """Take amount tokens, return the number of seconds waited"""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.
+
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+class Throttle:
+    """
+    Limit deletes to ops_per_second operations (unlink or rmdir) and
+    bytes_per_second bytes freed with token buckets, and pause all deletes
+    while an operation takes longer than max_latency seconds
+
+    A pause is as long as the slow operation, and doubles (up to MAX_PAUSE
+    seconds) for each slow operation after it. Fast operations halve it.
+    """
+    enabled = True
+
+    MAX_PAUSE = 10.
+
+    def __init__(self, ops_per_second=None, bytes_per_second=None, max_latency=None,
+                 clock=time.time, sleep=time.sleep):
+        import threading
+        self.logger = LazyLogger(self.__class__.__name__)
+
+        self.ops = (TokenBucket(ops_per_second, clock=clock, sleep=sleep)
+                    if ops_per_second else None)
+        self.bytes = (TokenBucket(bytes_per_second, clock=clock, sleep=sleep)
+                      if bytes_per_second else None)
+        self.max_latency = max_latency
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.pause = 0.
+        self.resume = 0.
+
+        # Seconds spent waiting, added up over all threads
+        self.waited = 0.
+
+    def wait(self, size=0, count=1):
+        """Wait until count operations freeing size bytes may start"""
+        with self.lock:
+            delay = self.resume - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        else:
+            delay = 0.
+
+        if self.ops is not None:
+            delay += self.ops.take(count)
+        if self.bytes is not None and size:
+            delay += self.bytes.take(size)
+
+        with self.lock:
+            self.waited += delay
+
+    def measure(self, latency):
+        """Record the latency of an operation, pausing if it was too slow"""
+        if self.max_latency is None:
+            return
+
+        with self.lock:
+            if latency > self.max_latency:
+                self.pause = min(max(2 * self.pause, latency), self.MAX_PAUSE)
+                self.resume = max(self.resume, self.clock() + self.pause)
+                self.logger.info('Operation took %.3f s, pausing for %.3f s', latency,
+                                 self.pause)
+            else:
+                self.pause /= 2
+
+    @contextlib.contextmanager
+    def operation(self, size=0):
+        """Wait (see wait()), then measure the operation in the with block"""
+        self.wait(size)
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.measure(self.clock() - started)
+
+
+class NullThrottle:
+    """
+    Stand-in for Throttle that never waits
+    """
+    enabled = False
+    waited = 0.
+
+    def wait(self, size=0, count=1):
+        pass
+
+    @contextlib.contextmanager
+    def operation(self, size=0):
+        yield
+
+NO_THROTTLE = NullThrottle()
+
+
+def tree_usage(path):
+    """
+    Get the number of bytes and inodes used by a directory tree
+    """
+    size, inodes = 0, 1
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            inodes += 1
+            if not stat.S_ISDIR(st.st_mode):
+                size += st.st_size
+
+    return size, inodes
+
+
+class Deleter:
+    """
+    Delete files and directory trees with a bounded pool of worker threads
+
+    Entries are removed relative to a file descriptor of their parent
+    directory where the platform supports it. Failures are logged and
+    counted per entry, and the bytes and inodes freed are accumulated.
+    With a throttle (see Throttle), directory trees are removed entry by
+    entry, so that each unlink and rmdir is rate limited.
+    """
+    def __init__(self, workers=4, throttle=NO_THROTTLE):
+        import threading
+        self.logger = LazyLogger(self.__class__.__name__)
+        self.workers = workers
+        self.throttle = throttle
+
+        self.lock = threading.Lock()
+        self.dir_fds = {}
+        self.use_dir_fd = os.unlink in getattr(os, 'supports_dir_fd', ())
+
+        self.deleted = 0
+        self.failed = 0
+        self.bytes_freed = 0
+        self.inodes_freed = 0
+
+    def delete(self, filenames):
+        """Delete all filenames, blocking until all workers are done"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for _ in executor.map(self.delete_one, filenames):
+                    pass
+        finally:
+            with self.lock:
+                for dir_fd in self.dir_fds.values():
+                    os.close(dir_fd)
+                self.dir_fds.clear()
+
+    def get_dir_fd(self, dirname):
+        with self.lock:
+            if dirname not in self.dir_fds:
+                self.dir_fds[dirname] = os.open(dirname or os.curdir, os.O_RDONLY)
+            return self.dir_fds[dirname]
+
+    def remove(self, filename):
+        """Remove a single file or directory tree, return (bytes, inodes)"""
+        import shutil
+        if not self.use_dir_fd:
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                if self.throttle.enabled:
+                    return self.remove_tree(filename)
+                usage = tree_usage(filename)
+                shutil.rmtree(filename)
+                return usage
+
+            with self.throttle.operation(st.st_size):
+                os.unlink(filename)
+            return (st.st_size, 1) if st.st_nlink == 1 else (0, 0)
+
+        dirname, basename = os.path.split(filename)
+        dir_fd = self.get_dir_fd(dirname)
+
+        st = os.stat(basename, dir_fd=dir_fd, follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode):
+            if self.throttle.enabled:
+                return self.remove_tree(filename)
+            usage = tree_usage(filename)
+            try:
+                shutil.rmtree(basename, dir_fd=dir_fd)
+            except TypeError:
+                # Python < 3.11
+                shutil.rmtree(filename)
+            return usage
+
+        with self.throttle.operation(st.st_size):
+            os.unlink(basename, dir_fd=dir_fd)
+        return (st.st_size, 1) if st.st_nlink == 1 else (0, 0)
+
+    def remove_tree(self, path):
+        """Remove a directory tree one entry at a time, return (bytes, inodes)"""
+        def onerror(e):
+            raise e
+
+        size, inodes = 0, 1
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False, onerror=onerror):
+            for name in filenames + dirnames:
+                entry = os.path.join(dirpath, name)
+                st = os.lstat(entry)
+                inodes += 1
+                if stat.S_ISDIR(st.st_mode):
+                    with self.throttle.operation():
+                        os.rmdir(entry)
+                    continue
+
+                with self.throttle.operation(st.st_size):
+                    os.unlink(entry)
+                size += st.st_size
+
+        with self.throttle.operation():
+            os.rmdir(path)
+        return size, inodes
+
+    def delete_one(self, filename):
+        try:
+            size, inodes = self.remove(filename)
+        except OSError as e:
+            self.logger.error('Could not delete %s: %s', filename, e)
+            with self.lock:
+                self.failed += 1
+            return
+
+        self.logger.info('Deleted %s', filename)
+        with self.lock:
+            self.deleted += 1
+            self.bytes_freed += size
+            self.inodes_freed += inodes
+
+    def summary(self):
+        summary = ('Deleted {0} entries ({1} failed), freed {2} bytes and {3} inodes'
+                   .format(self.deleted, self.failed, self.bytes_freed, self.inodes_freed))
+        if self.throttle.enabled:
+            summary += ', workers waited {0:.1f} s for the throttle'.format(
+                    self.throttle.waited)
+        return summary
+
+
+class LocalBackend:
+    """
+    Backups in a local directory
+    """
+    def __init__(self, directory, include_directories=False, cache=None, stats=NO_STATS,
+                 sizes=None, parser=parse_filename):
+        self.directory = directory
+        self.include_directories = include_directories
+        self.cache = cache
+        self.stats = stats
+        self.sizes = sizes
+
+        # The cache holds names parsed with parse_filename()
+        self.parse = parser if cache is None else cache.parse
+
+    def list(self, subdirectories=None):
+        """List backups (see find_backups())"""
+        if self.cache is not None:
+            return self.cache.find_backups(self.directory, self.include_directories,
+                                           subdirectories, self.sizes)
+
+        return find_backups(self.directory, self.include_directories, subdirectories,
+                            self.stats, self.sizes, self.parse)
+
+    def get_deleter(self, workers, throttle=NO_THROTTLE):
+        return Deleter(workers, throttle)
+
+
+class ListingBackend:
+    """
+    Backups listed in a binary stream (e.g. stdin), one path per line or
+    separated by NUL characters
+
+    Listed paths are used as they are, without any stat() calls, unless
+    verify is set (then only existing files, and directories if
+    include_directories is set, are considered).
+    """
+    def __init__(self, stream, separator=None, include_directories=False, verify=False,
+                 stats=NO_STATS, sizes=None, parser=parse_filename):
+        self.stream = stream
+        self.separator = separator
+        self.include_directories = include_directories
+        self.verify = verify
+        self.stats = stats
+        self.sizes = sizes
+
+        self.parse = parser
+
+    def list(self):
+        """Yield listed backups while reading the stream"""
+        for path in read_paths(self.stream, self.separator):
+            self.stats.count('entries_listed')
+            if self.verify:
+                self.stats.count('stat_calls', 2 if self.include_directories else 1)
+                if not ((self.include_directories and os.path.isdir(path)) or
+                        os.path.isfile(path)):
+                    continue
+
+            yield path
+
+    def get_deleter(self, workers, throttle=NO_THROTTLE):
+        return Deleter(workers, throttle)
+
+
+class S3Backend:
+    """
+    Backups in an S3-compatible object store, given as s3://bucket/prefix/
+
+    Like a local directory, only objects directly below the prefix are
+    listed. Requires boto3, the endpoint (e.g. a MinIO server) is taken from
+    $AWS_ENDPOINT_URL and credentials from the usual boto3 configuration.
+    """
+    def __init__(self, url, client=None, stats=NO_STATS, sizes=None, parser=parse_filename):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=os.environ.get('AWS_ENDPOINT_URL'))
+
+        self.client = client
+        self.bucket, _, self.key_prefix = url[len('s3://'):].partition('/')
+        if self.key_prefix and not self.key_prefix.endswith('/'):
+            self.key_prefix += '/'
+
+        self.parse = parser
+        self.sizes = {} if sizes is None else sizes
+        self.stats = stats
+
+    def get_url(self, key):
+        return 's3://{0}/{1}'.format(self.bucket, key)
+
+    def get_key(self, url):
+        return url[len('s3://') + len(self.bucket) + 1:]
+
+    def list(self):
+        """Yield URLs of all objects below the prefix, one page at a time"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key_prefix,
+                                       Delimiter='/'):
+            contents = page.get('Contents', ())
+            self.stats.count('entries_listed', len(contents))
+            for obj in contents:
+                url = self.get_url(obj['Key'])
+                self.sizes[url] = obj['Size']
+                yield url
+
+    def get_deleter(self, workers, throttle=NO_THROTTLE):
+        return S3Deleter(self, workers, throttle)
+
+
+class S3Deleter(Deleter):
+    """
+    Delete objects from an S3Backend using batched multi-object deletes
+
+    A throttle limits the objects and bytes deleted per second, but does
+    not pause for slow requests.
+    """
+    MAX_KEYS_PER_REQUEST = 1000
+
+    def __init__(self, backend, workers=4, throttle=NO_THROTTLE):
+        Deleter.__init__(self, workers, throttle)
+        self.backend = backend
+
+        try:
+            from botocore.exceptions import BotoCoreError, ClientError
+            self.errors = (BotoCoreError, ClientError)
+        except ImportError:
+            self.errors = ()
+
+    def delete(self, filenames):
+        """Delete all filenames, in batches of up to MAX_KEYS_PER_REQUEST"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        keys = sorted(self.backend.get_key(filename) for filename in filenames)
+        batches = [keys[i:i+self.MAX_KEYS_PER_REQUEST]
+                   for i in range(0, len(keys), self.MAX_KEYS_PER_REQUEST)]
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for _ in executor.map(self.delete_batch, batches):
+                pass
+
+    def delete_batch(self, keys):
+        self.throttle.wait(sum(self.backend.sizes.get(self.backend.get_url(key), 0)
+                               for key in keys), len(keys))
+        try:
+            response = self.backend.client.delete_objects(Bucket=self.backend.bucket,
+                    Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        except self.errors as e:
+            self.logger.error('Could not delete %d objects: %s', len(keys), e)
+            with self.lock:
+                self.failed += len(keys)
+            return
+
+        failed = set()
+        for error in response.get('Errors', ()):
+            self.logger.error('Could not delete %s: %s', self.backend.get_url(error['Key']),
+                              error.get('Message'))
+            failed.add(error['Key'])
+
+        deleted = [key for key in keys if key not in failed]
+        for key in deleted:
+            self.logger.info('Deleted %s', self.backend.get_url(key))
+
+        with self.lock:
+            self.deleted += len(deleted)
+            self.failed += len(failed)
+            self.bytes_freed += sum(self.backend.sizes.get(self.backend.get_url(key), 0)
+                                    for key in deleted)
+            self.inodes_freed += len(deleted)
+
+
+def get_backend(location, include_directories=False, cache=None, stats=NO_STATS,
+                sizes=None, parser=parse_filename):
+    """
+    Get the backend for a location: s3://bucket/prefix/, - (stdin) or a directory
+    """
+    if location.startswith('s3://'):
+        return S3Backend(location, stats=stats, sizes=sizes, parser=parser)
+    elif location == '-':
+        return ListingBackend(getattr(sys.stdin, 'buffer', sys.stdin), stats=stats,
+                              sizes=sizes, parser=parser)
+
+    return LocalBackend(location, include_directories, cache, stats, sizes, parser)
+
+
+def main(directory, days, months, years, separator, include_directories, prefix,
+         *, all_series=False, recursive=False, max_depth=None, threads=8,
+         delete=False, delete_workers=4, cache=False, hours=0,
+         from_file=None, null_input=False, verify_input=False, stats=None,
+         max_total_size=None, config=None, per_device=2, watch_interval=None,
+         plan_format=None, save_plan_file=None, apply_plan_file=None, tiers=None,
+         simulate_days=None, simulate_from=None, throttle=None, io_class=None, jobs=1,
+         date_formats=None):
+    if stats is None:
+        stats = NO_STATS
+    if throttle is None:
+        throttle = NO_THROTTLE
+
+    with stats.phase('total'):
+        return run(directory, days, months, years, separator, include_directories,
+                   prefix, all_series, recursive, max_depth, threads, delete,
+                   delete_workers, cache, hours, from_file, null_input, verify_input,
+                   stats, max_total_size, config, per_device, watch_interval,
+                   plan_format, save_plan_file, apply_plan_file, tiers, simulate_days,
+                   simulate_from, throttle, io_class, jobs, date_formats)
+
+
+def run(directory, days, months, years, separator, include_directories, prefix,
+        all_series, recursive, max_depth, threads, delete, delete_workers, cache,
+        hours, from_file, null_input, verify_input, stats, max_total_size, config,
+        per_device, watch_interval, plan_format, save_plan_file, apply_plan_file, tiers,
+        simulate_days, simulate_from, throttle, io_class, jobs, date_formats):
+    if io_class is not None and (delete or apply_plan_file is not None):
+        # Before the delete workers are started, so that they inherit it
+        try:
+            set_io_priority(io_class)
+        except OSError as e:
+            LazyLogger('run').warning('Could not set I/O priority: %s', e)
+
+    if apply_plan_file is not None:
+        deleter = Deleter(delete_workers, throttle)
+        with stats.phase('delete'):
+            changed, missing = apply_plan(apply_plan_file, deleter)
+
+        print('{0}, skipped {1} changed and {2} missing entries'.format(
+              deleter.summary(), changed, missing), file=sys.stderr)
+        return 1 if deleter.failed else 0
+
+    today = datetime.datetime.now()
+    policy = Policy(days, months, years, hours, max_total_size, tiers)
+    parser = get_parser(date_formats)
+    cache = ScanCache(stats=stats) if cache else None
+
+    # A single directory, or a list of directories
+    if directory is None or isinstance(directory, type('')):
+        directories = [] if directory is None else [directory]
+    else:
+        directories = list(directory)
+
+    locations = [(directory, policy) for directory in directories]
+    if config is not None:
+        locations.extend(load_config(config, policy))
+
+    if len(locations) == 1 and from_file is None:
+        # A single section of --config has its own policy
+        policy = locations[0][1]
+
+    sizes = {} if policy.max_total_size is not None or simulate_days is not None else None
+
+    # Listing file opened here, closed when done
+    opened = None
+    if from_file is not None:
+        if from_file == '-':
+            stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            stream = opened = open(from_file, 'rb')
+        backend = ListingBackend(stream, b'\0' if null_input else None,
+                                 include_directories, verify_input, stats, sizes, parser)
+        locations = [(from_file, policy)]
+    elif len(locations) == 1 and not recursive:
+        backend = get_backend(locations[0][0], include_directories, cache, stats, sizes,
+                              parser)
+    else:
+        backend = LocalBackend(None)
+
+    try:
+        if simulate_days is not None:
+            import csv
+
+            with stats.phase('list'):
+                filenames = list(backend.list())
+            if include_directories and not isinstance(backend, ListingBackend):
+                with stats.phase('size'):
+                    backend.sizes.update(disk_usage([filename for filename in filenames
+                                                     if filename not in backend.sizes]))
+
+            writer = csv.DictWriter(sys.stdout, SIMULATION_FIELDS, lineterminator='\n')
+            writer.writeheader()
+            for day in simulate(filenames, simulate_from or today.date(), simulate_days,
+                                policy, prefix, all_series, backend.parse, stats,
+                                backend.sizes, jobs):
+                with stats.phase('output'):
+                    writer.writerow(day)
+            sys.stdout.flush()
+            return 0
+
+        if plan_format is not None or save_plan_file is not None:
+            purge_lists = get_purge_lists(backend.list(), today, policy, prefix, all_series,
+                                          backend.parse, stats, backend.sizes, jobs)
+            with stats.phase('output'):
+                if save_plan_file is not None:
+                    save_plan(purge_lists, save_plan_file)
+                if plan_format is not None:
+                    write_plan(purge_lists, plan_format, sys.stdout)
+                    sys.stdout.flush()
+            return 0
+
+        if watch_interval is not None:
+            results = ((locations[0][0], purge_files) for purge_files in
+                       watch(locations[0][0], policy, include_directories, prefix, all_series,
+                             interval=watch_interval, parser=parser))
+        elif recursive:
+            results = itertools.chain.from_iterable(
+                    purge_tree(directory, today, policy, include_directories, prefix,
+                               all_series, max_depth, threads, cache, stats, parser)
+                    for directory, policy in locations)
+        elif len(locations) > 1:
+            results = purge_locations(locations, today, include_directories, prefix,
+                                      all_series, threads, per_device, cache, stats, parser)
+        else:
+            results = [(locations[0][0], purge_filenames(backend.list(), today, policy,
+                                                         prefix, all_series, backend.parse,
+                                                         stats, backend.sizes, jobs))]
 
+        # Directories skipped by purge_tree() (None instead of a list)
+        skipped = 0
 
-def main(directory, days, months, years, separator, include_directories, prefix):
-    today = datetime.date.today()
-    filenames = find_backups(directory, include_directories)
+        if delete:
+            deleter = backend.get_deleter(delete_workers, throttle)
+            for _, purge_files in results:
+                if purge_files is None:
+                    skipped += 1
+                    continue
+                with stats.phase('delete'):
+                    deleter.delete(purge_files)
+                if watch_interval is not None:
+                    print(deleter.summary(), file=sys.stderr)
 
-    purge_list = PurgeList(filenames, today, prefix)
-    purge_list.keep_daily(days)
-    purge_list.keep_monthly(months)
-    purge_list.keep_yearly(years)
+            print(deleter.summary(), file=sys.stderr)
+            return 1 if deleter.failed or skipped else 0
 
-    purge_files = purge_list.get_filenames()
-    if purge_files:
-        print(separator.join(purge_files), end=separator)
+        for _, purge_files in results:
+            if purge_files is None:
+                skipped += 1
+                continue
+            with stats.phase('output'):
+                write_filenames(purge_files, separator)
 
+        return 1 if skipped else 0
+    finally:
+        if opened is not None:
+            opened.close()
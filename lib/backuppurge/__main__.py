@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# Allow running as "python -m backuppurge"
+
+import sys
+
+from backuppurge.cli import main
+
+sys.exit(main())
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# backuppurge: Selectively purge daily full backups
+#
+# Copyright (c) 2013, 2015 Thomas Perl <m@thp.io>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Command line interface (used by the backuppurge script, the console_scripts
+entry point and "python -m backuppurge")
+"""
+
+import argparse
+import datetime
+
+import backuppurge
+
+
+def configure_logging():
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+
+def parse_date(date):
+    return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+
+def main(argv=None, prog='backuppurge'):
+    parser = argparse.ArgumentParser(prog=prog)
+
+    parser.add_argument('DIRECTORY', type=str, nargs='*',
+            help='Directory to look for backup files (or s3://bucket/prefix/, - for stdin)')
+    parser.add_argument('-c', '--config', default=None, type=str, metavar='PATH',
+            help='Read directories and per-directory policies from a config file')
+    parser.add_argument('--hours', default=0, type=int,
+            help='Number of hours to keep (0 to disable)')
+    parser.add_argument('-d', '--days', default=30, type=int,
+            help='Number of days to keep')
+    parser.add_argument('-m', '--months', default=6, type=int,
+            help='Number of months to keep (0 to disable)')
+    parser.add_argument('-y', '--years', default=5, type=int,
+            help='Number of years to keep (0 to disable)')
+    parser.add_argument('--tiers', default=None, type=backuppurge.parse_tiers,
+            metavar='TIERS', help='Tiers to keep as TIER:COUNT[:first|last],... '
+            '(TIER: hourly, daily, weekly, monthly, quarterly or yearly), '
+            'instead of --hours, -d, -m and -y')
+    parser.add_argument('--date-format', default=None, action='append',
+            dest='date_formats', metavar='FORMAT',
+            help='Find dates in names with a strftime() format (e.g. %%Y%%m%%d, fields '
+            '%%Y %%y %%m %%d %%H %%M %%S) instead of YYYY-MM-DD[THH[MM[SS]]], '
+            'can be given more than once')
+    parser.add_argument('--max-total-size', default=None, type=backuppurge.parse_size,
+            metavar='SIZE', help='Also purge oldest backups until kept backups fit in SIZE')
+    parser.add_argument('-0', '--print0', action='store_true', default=False,
+            help='Output filenames separated by NUL (for use with xargs)')
+    parser.add_argument('--from-file', default=None, type=str, metavar='PATH',
+            help='Read backup paths from a listing file instead of DIRECTORY')
+    parser.add_argument('--from-stdin', action='store_const', const='-', dest='from_file',
+            help='Read backup paths from stdin instead of DIRECTORY')
+    parser.add_argument('-z', '--null-input', action='store_true', default=False,
+            help='Listed paths are separated by NUL (default: newline)')
+    parser.add_argument('--verify-input', action='store_true', default=False,
+            help='Only use listed paths that exist (needs one stat per path)')
+    parser.add_argument('-D', '--include-directories', action='store_true', default=False,
+            help='Include directories when searching for backups')
+    parser.add_argument('-p', '--prefix', default=None, type=str,
+            help='Specify prefix to use if multiple prefixes are found')
+    parser.add_argument('-a', '--all-series', action='store_true', default=False,
+            help='Purge each backup series (prefix/postfix) found separately')
+    parser.add_argument('-r', '--recursive', action='store_true', default=False,
+            help='Purge each subdirectory of DIRECTORY as a separate location')
+    parser.add_argument('--max-depth', default=None, type=int,
+            help='Maximum depth of subdirectories for --recursive (default: unlimited)')
+    parser.add_argument('--threads', default=8, type=int,
+            help='Number of directories to scan concurrently')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+            help='Number of processes parsing the listing of a single DIRECTORY or '
+            '--from-file (default: 1)')
+    parser.add_argument('--per-device', default=2, type=int,
+            help='Number of directories on the same device to scan concurrently')
+    parser.add_argument('--delete', action='store_true', default=False,
+            help='Delete backups to purge instead of printing them')
+    parser.add_argument('--delete-workers', default=4, type=int,
+            help='Number of entries to delete concurrently for --delete')
+    parser.add_argument('--delete-rate', default=None, type=float, metavar='OPS',
+            help='Remove at most OPS files and directories per second')
+    parser.add_argument('--delete-bandwidth', default=None, type=backuppurge.parse_size,
+            metavar='SIZE', help='Free at most SIZE bytes per second')
+    parser.add_argument('--max-unlink-latency', default=None, type=float, metavar='MS',
+            help='Pause deleting while removing an entry takes longer than MS milliseconds')
+    parser.add_argument('--ionice', default=None, choices=('best-effort', 'idle'),
+            help='I/O scheduling class for deleting (Linux only)')
+    parser.add_argument('--plan', default=None, choices=('jsonl', 'csv'),
+            help='Write every backup with its decision and reason instead of purging')
+    parser.add_argument('--save-plan', default=None, type=str, metavar='PATH',
+            help='Save the plan (with inode, size and mtime) to PATH instead of purging')
+    parser.add_argument('--apply-plan', default=None, type=str, metavar='PATH',
+            help='Delete the backups to purge in a plan saved with --save-plan')
+    parser.add_argument('--simulate', default=None, type=int, metavar='DAYS',
+            help='Replay daily runs over DAYS days and write the backups kept and '
+            'purged each day as CSV instead of purging')
+    parser.add_argument('--simulate-from', default=None, type=parse_date, metavar='DATE',
+            help='First day (YYYY-MM-DD) for --simulate (default: today)')
+    parser.add_argument('-w', '--watch', action='store_true', default=False,
+            help='Keep running, purge DIRECTORY again when new backups arrive')
+    parser.add_argument('--watch-interval', default=60, type=int, metavar='SECONDS',
+            help='Polling interval for --watch without inotify (default: 60)')
+    parser.add_argument('--cache', action='store_true', default=False,
+            help='Cache directory listings in $XDG_CACHE_HOME/backuppurge')
+    parser.add_argument('--stats', default=None, choices=('json', 'prometheus'),
+            help='Report time and counters for each phase to stderr')
+    parser.add_argument('--stats-file', default=None, type=str, metavar='PATH',
+            help='Write the --stats report to PATH instead of stderr')
+    parser.add_argument('-V', '--verbose', action='store_true', default=False,
+            help='Verbose output of decisions to stderr')
+    parser.add_argument('-v', '--version', action='version',
+            version=backuppurge.__version__,
+            help='show version number and exit')
+
+    args = parser.parse_args(argv)
+
+    if args.apply_plan is not None:
+        if args.DIRECTORY or args.config or args.from_file is not None or args.save_plan:
+            parser.error('--apply-plan does not take DIRECTORY or other sources')
+    elif (args.DIRECTORY or args.config) and args.from_file is not None:
+        parser.error('DIRECTORY and --config cannot be used with --from-file/--from-stdin')
+    elif not (args.DIRECTORY or args.config or args.from_file is not None):
+        parser.error('DIRECTORY, --config or --from-file/--from-stdin is required')
+
+    remote = [directory for directory in args.DIRECTORY
+              if directory == '-' or directory.startswith('s3://')]
+    if remote and (args.recursive or args.config or len(args.DIRECTORY) > 1):
+        parser.error('{0} cannot be combined with other directories or --recursive'
+                     .format(remote[0]))
+
+    if args.recursive and args.from_file is not None:
+        parser.error('--recursive only works with local directories')
+
+    if args.watch and (remote or args.recursive or args.config or
+                       len(args.DIRECTORY) != 1):
+        parser.error('--watch only works with a single local DIRECTORY')
+
+    if (args.plan or args.save_plan) and (args.delete or args.watch or args.recursive or
+                                          args.config or len(args.DIRECTORY) > 1):
+        parser.error('--plan and --save-plan only work with a single DIRECTORY or '
+                     'listing, without --delete, --watch or --recursive')
+
+    if args.simulate_from is not None and args.simulate is None:
+        parser.error('--simulate-from requires --simulate')
+
+    if args.simulate is not None and (args.plan or args.save_plan or args.delete or
+                                      args.watch or args.recursive or args.config or
+                                      len(args.DIRECTORY) > 1):
+        parser.error('--simulate only works with a single DIRECTORY or listing, without '
+                     '--plan, --save-plan, --delete, --watch or --recursive')
+
+    if args.save_plan and remote and remote[0] != '-':
+        parser.error('--save-plan only works with local backups')
+
+    if args.date_formats:
+        if args.cache:
+            parser.error('--cache cannot be used with --date-format')
+        try:
+            backuppurge.DateFormat(args.date_formats)
+        except ValueError as e:
+            parser.error(str(e))
+
+    throttled = (args.delete_rate or args.delete_bandwidth or
+                 args.max_unlink_latency is not None)
+    if (throttled or args.ionice) and not (args.delete or args.apply_plan):
+        parser.error('--delete-rate, --delete-bandwidth, --max-unlink-latency and '
+                     '--ionice only work with --delete or --apply-plan')
+
+    throttle = None
+    if throttled:
+        throttle = backuppurge.Throttle(args.delete_rate, args.delete_bandwidth,
+                                        None if args.max_unlink_latency is None else
+                                        args.max_unlink_latency / 1000.)
+
+    sep = ('\0' if args.print0 else '\n')
+
+    if args.verbose:
+        import logging
+        logging.basicConfig(level=logging.DEBUG)
+        logging.getLogger(__name__).debug('Configuration: %r', args)
+    else:
+        # Logging is only set up once something is logged
+        backuppurge.LazyLogger.configure = configure_logging
+
+    stats = backuppurge.Stats() if args.stats else None
+    try:
+        status = backuppurge.main(args.DIRECTORY, args.days, args.months, args.years, sep,
+                                  args.include_directories, args.prefix,
+                                  all_series=args.all_series,
+                                  recursive=args.recursive,
+                                  max_depth=args.max_depth,
+                                  threads=args.threads,
+                                  delete=args.delete,
+                                  delete_workers=args.delete_workers,
+                                  cache=args.cache,
+                                  hours=args.hours,
+                                  from_file=args.from_file,
+                                  null_input=args.null_input,
+                                  verify_input=args.verify_input,
+                                  stats=stats,
+                                  max_total_size=args.max_total_size,
+                                  config=args.config,
+                                  per_device=args.per_device,
+                                  watch_interval=args.watch_interval if args.watch else None,
+                                  plan_format=args.plan,
+                                  save_plan_file=args.save_plan,
+                                  apply_plan_file=args.apply_plan,
+                                  tiers=args.tiers,
+                                  simulate_days=args.simulate,
+                                  simulate_from=args.simulate_from,
+                                  throttle=throttle,
+                                  io_class=args.ionice,
+                                  jobs=args.jobs,
+                                  date_formats=args.date_formats)
+    except KeyboardInterrupt:
+        # The usual way to stop --watch
+        status = 130
+
+    if stats is not None:
+        stats.write(args.stats, args.stats_file)
+
+    return status
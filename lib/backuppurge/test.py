@@ -6,6 +6,13 @@ from __future__ import print_function
 from nose.tools import *
 
 import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from unittest import SkipTest
 
 import backuppurge
 
@@ -276,3 +283,1034 @@ def test_multiple_prefixes_when_specifying_prefix():
 
     for prefix, expected_keep_set in prefix_to_expected_keep_set.items():
         yield check_with_prefix, prefix, expected_keep_set
+
+def test_get_all_and_get_first_use_date_index():
+    """
+    Test that lookups by year, month and day work on unsorted input
+    """
+    filenames = list(reversed(FixtureData.get_filenames()))
+    today = FixtureData.TODAY
+    prefix = None
+
+    purge_list = backuppurge.PurgeList(filenames, today, prefix)
+
+    assert_equal(len(purge_list.get_all(2013, 3)), 31)
+    assert_equal(len(purge_list.get_all(2012)), 366)
+    assert_equal(purge_list.get_all(2013, 2, 28), ['backup-2013-02-28.tar.gz'])
+
+    assert_equal(purge_list.get_first(2012), 'backup-2012-01-01.tar.gz')
+    assert_equal(purge_list.get_first(2012, 12), 'backup-2012-12-01.tar.gz')
+    assert_equal(purge_list.get_first(2013, 3, 31), 'backup-2013-03-31.tar.gz')
+    assert_equal(purge_list.get_first(2013, 4), None)
+    assert_equal(purge_list.get_first(2009), None)
+
+
+def test_find_backups_skips_undated_and_directories():
+    """
+    Test that find_backups only yields dated files (and dated directories
+    if include_directories is set)
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for filename in ('etc-2013-03-30.tgz', 'etc-2013-03-31.tgz', 'README'):
+            open(os.path.join(directory, filename), 'w').close()
+        os.mkdir(os.path.join(directory, 'etc-2013-03-29'))
+        os.mkdir(os.path.join(directory, 'lost+found'))
+
+        files = set(backuppurge.find_backups(directory, False))
+        assert_equal(files, {
+            os.path.join(directory, 'etc-2013-03-30.tgz'),
+            os.path.join(directory, 'etc-2013-03-31.tgz'),
+        })
+
+        files_and_dirs = set(backuppurge.find_backups(directory, True))
+        assert_equal(files_and_dirs, files.union({
+            os.path.join(directory, 'etc-2013-03-29'),
+        }))
+    finally:
+        shutil.rmtree(directory)
+
+def test_group_series():
+    """
+    Test that filenames are grouped by prefix and postfix
+    """
+    filenames = [
+        'homedir-2013-03-31.tar.gz',
+        'homedir-2013-03-30.tar.gz',
+        'homedir-2013-03-30.tar.bz2',
+        'backup-2013-03-21.tar.gz',
+        'README',
+    ]
+
+    series = backuppurge.group_series(filenames)
+
+    assert_equal(series, {
+        ('homedir-', '.tar.gz'): ['homedir-2013-03-31.tar.gz', 'homedir-2013-03-30.tar.gz'],
+        ('homedir-', '.tar.bz2'): ['homedir-2013-03-30.tar.bz2'],
+        ('backup-', '.tar.gz'): ['backup-2013-03-21.tar.gz'],
+    })
+
+def test_all_series_parses_each_filename_once():
+    """
+    Test that filenames are not parsed again after grouping them by series
+    """
+    filenames = FixtureData.get_filenames()
+    filenames += [filename.replace('.tar.gz', '.tgz') for filename in filenames]
+    calls = []
+
+    def parser(filename):
+        calls.append(filename)
+        return backuppurge.parse_filename(filename)
+
+    policy = backuppurge.Policy(days=30, months=6, years=2)
+    purge_files = backuppurge.purge_filenames(filenames, FixtureData.TODAY, policy,
+                                              None, True, parser)
+
+    assert_equal(len(calls), len(filenames))
+    assert_equal(len(purge_files), len(filenames) - 2 * (30 + 6 + 2 - 1))
+
+def test_purge_tree_treats_each_directory_as_series():
+    """
+    Test that recursive purging evaluates each directory separately (also
+    directories with subdirectories) and respects the maximum depth
+    """
+    root = tempfile.mkdtemp()
+    try:
+        for subdirectory in ('host1', 'host1/etc', 'host1/home', 'host2/etc', 'host3/etc'):
+            os.makedirs(os.path.join(root, subdirectory))
+            for day in (29, 30, 31):
+                filename = 'backup-2013-03-{0}.tgz'.format(day)
+                open(os.path.join(root, subdirectory, filename), 'w').close()
+        # Directory backups are not descended into
+        os.makedirs(os.path.join(root, 'host2', 'etc', 'backup-2013-03-28', 'x'))
+        # Two series: skipped, but its subdirectories are not
+        for filename in ('notes-2013-01-01.txt', 'inventory-2013-02-02.csv'):
+            open(os.path.join(root, 'host3', filename), 'w').close()
+
+        def purge(max_depth):
+            policy = backuppurge.Policy(days=2, months=0, years=0)
+            results = backuppurge.purge_tree(root, FixtureData.TODAY, policy,
+                                             False, None, False, max_depth)
+            return dict((os.path.relpath(directory, root),
+                         purge_files and set(os.path.basename(f) for f in purge_files))
+                        for directory, purge_files in results)
+
+        assert_equal(purge(None), {
+            '.': [],
+            'host1': {'backup-2013-03-29.tgz'},
+            'host2': [],
+            'host3': None,
+            'host1/etc': {'backup-2013-03-29.tgz'},
+            'host1/home': {'backup-2013-03-29.tgz'},
+            'host2/etc': {'backup-2013-03-29.tgz'},
+            'host3/etc': {'backup-2013-03-29.tgz'},
+        })
+        assert_equal(set(purge(1)), {'.', 'host1', 'host2', 'host3'})
+
+        stdout = sys.stdout
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        try:
+            status = backuppurge.main(root, 2, 0, 0, '\n', False, None, recursive=True)
+            output = sys.stdout.buffer.getvalue().decode('utf-8')
+        finally:
+            sys.stdout = stdout
+        assert_equal(status, 1)
+        # Every backup is older than two days today
+        assert_equal(len(output.split()), 15)
+    finally:
+        shutil.rmtree(root)
+
+def test_purge_locations_with_per_directory_policies():
+    """
+    Test that a config file sets per-directory policies, and that every
+    directory is purged with its own policy
+    """
+    root = tempfile.mkdtemp()
+    try:
+        for subdirectory in ('db', 'etc'):
+            os.makedirs(os.path.join(root, subdirectory))
+            for day in (28, 29, 30, 31):
+                filename = 'backup-2013-03-{0}.tgz'.format(day)
+                open(os.path.join(root, subdirectory, filename), 'w').close()
+
+        config = os.path.join(root, 'backuppurge.ini')
+        with open(config, 'w') as fp:
+            fp.write('[DEFAULT]\nmonths = 0\nyears = 0\n\n'
+                     '[{0}]\ndays = 3\n\n[{1}]\n'.format(os.path.join(root, 'db'),
+                                                        os.path.join(root, 'etc')))
+
+        policy = backuppurge.Policy(days=1, months=6, years=5)
+        locations = backuppurge.load_config(config, policy)
+        assert_equal([(os.path.basename(directory), policy.days, policy.months)
+                      for directory, policy in locations],
+                     [('db', 3, 0), ('etc', 1, 0)])
+
+        results = backuppurge.purge_locations(locations, FixtureData.TODAY, False,
+                                              None, False, per_device=1)
+        assert_equal(dict((os.path.basename(directory),
+                           set(os.path.basename(f) for f in purge_files))
+                          for directory, purge_files in results), {
+            'db': {'backup-2013-03-28.tgz'},
+            'etc': {'backup-2013-03-28.tgz', 'backup-2013-03-29.tgz',
+                    'backup-2013-03-30.tgz'},
+        })
+    finally:
+        shutil.rmtree(root)
+
+def test_config_with_one_section_uses_its_policy():
+    """
+    Test that a config file with a single directory is purged with the
+    policy of its section, including its size budget
+    """
+    root = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        today = datetime.date.today()
+        for days in range(10):
+            date = today - datetime.timedelta(days=days)
+            with open(os.path.join(root, date.strftime('backup-%Y-%m-%d.tgz')), 'w') as fp:
+                fp.write('x' * 10)
+
+        config = os.path.join(root, 'backuppurge.ini')
+        for options, kept in (('days = 2\nmonths = 0\nyears = 0\n', 2),
+                              ('max-total-size = 30\n', 3)):
+            with open(config, 'w') as fp:
+                fp.write('[{0}]\n{1}'.format(root, options))
+
+            sys.stdout = io.TextIOWrapper(io.BytesIO())
+            assert_equal(backuppurge.main(None, 30, 6, 5, '\n', False, None,
+                                          config=config), 0)
+            output = sys.stdout.buffer.getvalue().decode('utf-8')
+            sys.stdout = stdout
+            assert_equal(len(output.split()), 10 - kept)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(root)
+
+@raises(TypeError)
+def test_main_options_are_keyword_only():
+    """
+    Test that main() keeps its positional parameters, options are keywords
+    """
+    backuppurge.main('.', 30, 6, 5, '\n', False, None, True)
+
+def test_cli_main_prints_purged_files():
+    """
+    Test the command line interface entry point, without setting up logging
+    """
+    import backuppurge.cli
+
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        today = datetime.date.today()
+        for days in range(5):
+            date = today - datetime.timedelta(days=days)
+            open(os.path.join(directory, date.strftime('backup-%Y-%m-%d.tgz')), 'w').close()
+
+        sys.stdout = io.TextIOWrapper(io.BytesIO())
+        status = backuppurge.cli.main(['-d', '3', '-m', '0', '-y', '0', directory])
+        output = sys.stdout.buffer.getvalue().decode('utf-8')
+    finally:
+        sys.stdout = stdout
+        backuppurge.LazyLogger.configure = None
+        shutil.rmtree(directory)
+
+    assert_equal(status, 0)
+    assert_equal(sorted(os.path.basename(f) for f in output.split()), [
+        (today - datetime.timedelta(days=days)).strftime('backup-%Y-%m-%d.tgz')
+        for days in (4, 3)])
+
+def test_write_filenames_in_date_order_and_chunks():
+    """
+    Test that purged files are written in date order, in flushed chunks
+    """
+    class FlushCounter(io.BytesIO):
+        flushes = 0
+
+        def flush(self):
+            self.flushes += 1
+
+    filenames = backuppurge.purge_filenames(FixtureData.get_filenames(), FixtureData.TODAY,
+                                            backuppurge.Policy(days=5, months=0, years=0),
+                                            None, False)
+    assert_equal(filenames, sorted(filenames))
+
+    stream = FlushCounter()
+    backuppurge.write_filenames(filenames, '\0', stream)
+    assert_equal(stream.getvalue().split(b'\0')[:-1],
+                 [filename.encode('utf-8') for filename in filenames])
+    assert_equal(stream.flushes, 1)
+
+    chunked = FlushCounter()
+    backuppurge.write_filenames(filenames, '\0', chunked, chunk_size=100)
+    assert_equal(chunked.getvalue(), stream.getvalue())
+    assert len(filenames) > chunked.flushes > len(stream.getvalue()) // 100
+
+class FakeWatcher:
+    """
+    Watcher that reports scripted changes, advancing a fake clock (created
+    files are written with their contents, if given)
+    """
+    def __init__(self, directory, steps, contents=None):
+        self.directory = directory
+        self.steps = list(steps)
+        self.contents = contents or {}
+        self.now = datetime.datetime(2013, 3, 31, 12, 0)
+        self.closed = False
+
+    def wait(self, timeout):
+        created, removed, days = self.steps.pop(0)
+        for name in created:
+            with open(os.path.join(self.directory, name), 'w') as fp:
+                fp.write(self.contents.get(name, ''))
+        for name in removed:
+            os.remove(os.path.join(self.directory, name))
+        self.now += datetime.timedelta(days=days)
+        return [(name, True) for name in created] + [(name, False) for name in removed]
+
+    def close(self):
+        self.closed = True
+
+def test_watch_emits_newly_purgeable_backups_once():
+    """
+    Test that watch mode updates the index incrementally and yields each
+    purgeable backup once, on new dates and when the day rolls over
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for day in (29, 30, 31):
+            open(os.path.join(directory, 'backup-2013-03-{0}.tgz'.format(day)), 'w').close()
+
+        watcher = FakeWatcher(directory, [
+            # Second backup of the same day: purged right away
+            (['backup-2013-03-31T1800.tgz'], [], 0),
+            # Not a backup, deletion of a purged backup
+            (['notes.txt'], ['backup-2013-03-31T1800.tgz'], 0),
+            # New day, new backup
+            (['backup-2013-04-01.tgz'], [], 1),
+        ])
+        policy = backuppurge.Policy(days=2, months=0, years=0)
+        results = backuppurge.watch(directory, policy, False, None, False, watcher,
+                                    now=lambda: watcher.now)
+
+        def names(purge_files):
+            return set(os.path.basename(f) for f in purge_files)
+
+        assert_equal(names(next(results)), {'backup-2013-03-29.tgz'})
+        assert_equal(names(next(results)), {'backup-2013-03-31T1800.tgz'})
+        assert_equal(names(next(results)), {'backup-2013-03-30.tgz'})
+        results.close()
+        assert watcher.closed
+    finally:
+        shutil.rmtree(directory)
+
+def test_watch_keeps_new_last_backup_of_a_day():
+    """
+    Test that a new backup sorting last among those with the same date is
+    kept instead of the previous one with a tier keeping the last backup
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        open(os.path.join(directory, 'db-2013-03-31.sql'), 'w').close()
+
+        watcher = FakeWatcher(directory, [(['db-2013-03-31T00.sql'], [], 0)])
+        policy = backuppurge.Policy(tiers=backuppurge.parse_tiers('daily:5:last'))
+        results = backuppurge.watch(directory, policy, False, None, False, watcher,
+                                    now=lambda: watcher.now)
+
+        assert_equal([os.path.basename(f) for f in next(results)], ['db-2013-03-31.sql'])
+        results.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_watch_size_budget_uses_size_after_writing():
+    """
+    Test that the size of a backup is looked up again once it is written
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'backup-2013-03-30.tgz'), 'w') as fp:
+            fp.write('x' * 10)
+        open(os.path.join(directory, 'backup-2013-03-31.tgz'), 'w').close()
+
+        # Reported again when closed after writing
+        watcher = FakeWatcher(directory, [(['backup-2013-03-31.tgz'], [], 0)],
+                              {'backup-2013-03-31.tgz': 'x' * 10})
+        policy = backuppurge.Policy(days=30, months=0, years=0, max_total_size=15)
+        results = backuppurge.watch(directory, policy, False, None, False, watcher,
+                                    now=lambda: watcher.now)
+
+        assert_equal([os.path.basename(f) for f in next(results)],
+                     ['backup-2013-03-30.tgz'])
+        results.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_numpy_index_matches_pure_python():
+    """
+    Test that parsing and bucketing with NumPy gives the same result as
+    the pure Python code, including invalid and unordered dates
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('NumPy not installed')
+
+    filenames = ['backup-{0}.tgz'.format(date) for date in (
+        '2013-03-31', '2013-03-31T00', '2013-03-31T1830', '2013-03-30_23',
+        '2013-02-29', '2012-02-29 235959', '2013-04-31T12', '0000-01-01',
+        '2013-01-01', '2012-12-31', '2011-06-15T0600', '1999-12-31')]
+    last_hour = datetime.datetime(2013, 3, 31, 23)
+    filenames += [(last_hour - datetime.timedelta(hours=hours)).strftime('backup-%Y-%m-%dT%H.tgz')
+                  for hours in range(0, 24 * 800, 5)]
+    filenames.reverse()
+
+    def run(numpy_min_entries):
+        saved = (backuppurge.NUMPY_MIN_ENTRIES, backuppurge.PARSE_CHUNK_SIZE,
+                 backuppurge.BUCKETS_PER_LOOKUP)
+        backuppurge.NUMPY_MIN_ENTRIES = numpy_min_entries
+        backuppurge.PARSE_CHUNK_SIZE = 1000
+        backuppurge.BUCKETS_PER_LOOKUP = 0
+        try:
+            purge_list = backuppurge.PurgeList(filenames, FixtureData.TODAY, None)
+            backuppurge.Policy(days=40, months=12, years=5, hours=72).apply(purge_list)
+        finally:
+            (backuppurge.NUMPY_MIN_ENTRIES, backuppurge.PARSE_CHUNK_SIZE,
+             backuppurge.BUCKETS_PER_LOOKUP) = saved
+
+        return (list(purge_list.index_times), purge_list.index_files,
+                purge_list.invalid_files, purge_list.kept, purge_list.kept_tiers)
+
+    expected = run(None)
+    assert_equal(len(expected[2]), 3)
+    assert_equal(run(1), expected)
+
+def test_deleter_removes_files_and_trees():
+    """
+    Test that files and directory trees are deleted, and failures counted
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'etc-2013-03-30.tgz'), 'w') as fp:
+            fp.write('x' * 100)
+        os.makedirs(os.path.join(directory, 'etc-2013-03-29', 'sub'))
+        with open(os.path.join(directory, 'etc-2013-03-29', 'sub', 'file'), 'w') as fp:
+            fp.write('x' * 20)
+
+        deleter = backuppurge.Deleter(workers=2)
+        deleter.delete([
+            os.path.join(directory, 'etc-2013-03-30.tgz'),
+            os.path.join(directory, 'etc-2013-03-29'),
+            os.path.join(directory, 'etc-2013-03-28.tgz'),
+        ])
+
+        assert_equal(os.listdir(directory), [])
+        assert_equal(deleter.deleted, 2)
+        assert_equal(deleter.failed, 1)
+        assert_equal(deleter.bytes_freed, 120)
+        assert_equal(deleter.inodes_freed, 4)
+    finally:
+        shutil.rmtree(directory)
+
+class InterruptedDeleter(backuppurge.Deleter):
+    """
+    Deleter that gets interrupted before deleting its second batch
+    """
+    def delete(self, filenames):
+        if self.deleted:
+            raise KeyboardInterrupt()
+        backuppurge.Deleter.delete(self, filenames)
+
+def test_apply_plan_verifies_entries_and_resumes():
+    """
+    Test that applying a saved plan skips changed backups, and continues
+    after the last complete batch when interrupted
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for day in range(1, 10):
+            filename = os.path.join(directory, 'backup-2013-03-0{0}.tgz'.format(day))
+            with open(filename, 'w') as fp:
+                fp.write('backup')
+            filenames.append(filename)
+
+        purge_list = backuppurge.PurgeList(filenames, FixtureData.TODAY, None)
+        backuppurge.Policy(days=0, months=0, years=0).apply(purge_list)
+        plan_file = os.path.join(directory, 'plan.jsonl')
+        backuppurge.save_plan([purge_list], plan_file)
+
+        with open(filenames[-1], 'a') as fp:
+            fp.write('changed')
+
+        deleter = InterruptedDeleter()
+        assert_raises(KeyboardInterrupt, backuppurge.apply_plan, plan_file, deleter, 3)
+        assert_equal(deleter.deleted, 3)
+
+        deleter = backuppurge.Deleter()
+        assert_equal(backuppurge.apply_plan(plan_file, deleter, 3), (1, 0))
+        assert_equal(deleter.deleted, 5)
+        assert_equal(sorted(os.listdir(directory)),
+                     ['backup-2013-03-09.tgz', 'plan.jsonl', 'plan.jsonl.journal'])
+
+        # Nothing left to do
+        assert_equal(backuppurge.apply_plan(plan_file, deleter, 3), (0, 0))
+        assert_equal(deleter.deleted, 5)
+    finally:
+        shutil.rmtree(directory)
+
+def test_scan_cache_reuses_unchanged_listing():
+    """
+    Test that the scan cache is used while the directory is unchanged and
+    updated (including removed entries) when it is modified
+    """
+    directory = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def touch(filename):
+            open(os.path.join(directory, filename), 'w').close()
+
+        def set_mtime(mtime):
+            os.utime(directory, (mtime, mtime))
+
+        def find_backups():
+            cache = backuppurge.ScanCache(cache_dir)
+            filenames = cache.find_backups(directory, False)
+            purge_list = backuppurge.PurgeList(filenames, FixtureData.TODAY, None,
+                                               cache.parse)
+            return set(os.path.basename(f) for f in purge_list.get_filenames())
+
+        touch('etc-2013-03-30.tgz')
+        touch('etc-2013-03-31.tgz')
+        set_mtime(1000000000)
+        assert_equal(find_backups(), {'etc-2013-03-30.tgz', 'etc-2013-03-31.tgz'})
+
+        # Unchanged mtime: listing comes from the cache
+        touch('etc-2013-03-29.tgz')
+        set_mtime(1000000000)
+        assert_equal(find_backups(), {'etc-2013-03-30.tgz', 'etc-2013-03-31.tgz'})
+
+        # Modified directory: new entries are added, removed ones dropped
+        os.unlink(os.path.join(directory, 'etc-2013-03-31.tgz'))
+        set_mtime(1000000100)
+        assert_equal(find_backups(), {'etc-2013-03-29.tgz', 'etc-2013-03-30.tgz'})
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(cache_dir)
+
+def test_scan_cache_stores_sizes():
+    """
+    Test that the scan cache fills sizes from its entries, except for files
+    modified right before the scan
+    """
+    directory = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for filename, size, mtime in (('etc-2013-03-30.tgz', 3, 1000000000),
+                                      ('etc-2013-03-31.tgz', 5, None)):
+            path = os.path.join(directory, filename)
+            with open(path, 'w') as fp:
+                fp.write('x' * size)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        os.utime(directory, (1000000000, 1000000000))
+
+        def find_sizes():
+            stats = backuppurge.Stats()
+            sizes = {}
+            cache = backuppurge.ScanCache(cache_dir, stats)
+            cache.find_backups(directory, False, sizes=sizes)
+            return (dict((os.path.basename(f), size) for f, size in sizes.items()),
+                    stats.counters['stat_calls'])
+
+        # Directory stat plus one per file when scanning, the directory only
+        # when the listing comes from the cache
+        assert_equal(find_sizes(), ({'etc-2013-03-30.tgz': 3}, 3))
+        assert_equal(find_sizes(), ({'etc-2013-03-30.tgz': 3}, 1))
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(cache_dir)
+
+def test_hourly_backups():
+    """
+    Test that multiple backups per day are told apart by their time
+    """
+    filenames = [
+        'db-2013-03-31T0500.sql.gz', 'db-2013-03-31T0400.sql.gz',
+        'db-2013-03-31T0330.sql.gz', 'db-2013-03-31T0300.sql.gz',
+        'db-2013-03-31T0000.sql.gz', 'db-2013-03-30T2300.sql.gz',
+        'db-2013-03-30T1200.sql.gz', 'db-2013-03-30T0100.sql.gz',
+    ]
+    today = datetime.datetime(2013, 3, 31, 5, 30)
+    prefix = None
+
+    purge_list = backuppurge.PurgeList(filenames, today, prefix)
+    assert_equal(purge_list.get_all(2013, 3, 31, 3),
+                 ['db-2013-03-31T0300.sql.gz', 'db-2013-03-31T0330.sql.gz'])
+
+    purge_list.keep_hourly(3)
+    purge_list.keep_daily(2)
+
+    purge_set = purge_list.get_filenames()
+    keep_set = set(filenames).difference(purge_set)
+
+    expected_keep_set = {
+        # Hours (05:00, 04:00, 03:00)
+        'db-2013-03-31T0500.sql.gz', 'db-2013-03-31T0400.sql.gz',
+        'db-2013-03-31T0300.sql.gz',
+
+        # Days
+        'db-2013-03-31T0000.sql.gz', 'db-2013-03-30T0100.sql.gz',
+    }
+
+    assert_equal(keep_set, expected_keep_set)
+
+def test_digits_after_date_that_are_no_time():
+    """
+    Test that digits after the date that are not a valid time of day are
+    part of the postfix, as before times of day were supported
+    """
+    today = FixtureData.TODAY
+    dates = [today - datetime.timedelta(days=days) for days in range(10)]
+    for postfix in ('_8080.tar', 'T2460.tar', '_12300.tar', 'T1261.tar'):
+        filenames = [date.strftime('site-%Y-%m-%d') + postfix for date in dates]
+        assert_equal(set(backuppurge.parse_filename(filename)[2]
+                         for filename in filenames), {postfix})
+        assert_equal(backuppurge.purge_filenames(filenames, today, backuppurge.Policy(),
+                                                 None, False), [])
+
+    assert_equal(backuppurge.parse_filename('db-2013-03-31_1230.sql'),
+                 ('db-', '2013-03-31_1230', '.sql'))
+
+def test_plan_consumes_iterator_and_yields_decisions():
+    """
+    Test that plan() accepts a one-shot iterator and yields decisions with
+    reasons in date order
+    """
+    filenames = iter(reversed(FixtureData.get_filenames()))
+    today = FixtureData.TODAY
+    policy = backuppurge.Policy(days=2, months=2, years=0)
+
+    decisions = list(backuppurge.plan(filenames, today, policy))
+    kept = [(filename, reason) for filename, decision, reason in decisions
+            if decision == 'keep']
+
+    assert_equal(len(decisions), 3*365)
+    assert_equal(decisions[0], ('backup-2010-04-02.tar.gz', 'purge', None))
+    assert_equal(kept, [
+        ('backup-2013-02-01.tar.gz', 'monthly (2013-02)'),
+        ('backup-2013-03-01.tar.gz', 'monthly (2013-03)'),
+        ('backup-2013-03-30.tar.gz', 'daily'),
+        ('backup-2013-03-31.tar.gz', 'daily'),
+    ])
+
+def test_weekly_quarterly_and_last_of_period_tiers():
+    """
+    Test declared tiers with ISO weeks, quarters and the last backup of
+    each period, also as read from a config file
+    """
+    start = datetime.date(2012, 12, 1)
+    filenames = [(start + datetime.timedelta(days=days)).strftime('backup-%Y-%m-%d.tgz')
+                 for days in range(121)]
+    tiers = backuppurge.parse_tiers('weekly:2:last, quarterly:2')
+    assert_equal(tiers, [backuppurge.Tier('weekly', 2, 'last'),
+                         backuppurge.Tier('quarterly', 2, 'first')])
+
+    purge_list = backuppurge.PurgeList(filenames, FixtureData.TODAY, None)
+    backuppurge.Policy(tiers=tiers).apply(purge_list)
+    assert_equal(purge_list.kept, {
+        'backup-2013-03-31.tgz': 'weekly (2013-W13)',
+        'backup-2013-03-24.tgz': 'weekly (2013-W12)',
+        'backup-2013-01-01.tgz': 'quarterly (2013-Q1)',
+        'backup-2012-12-01.tgz': 'quarterly (2012-Q4)',
+    })
+
+    assert_raises(ValueError, backuppurge.parse_tiers, 'fortnightly:2')
+    assert_raises(ValueError, backuppurge.parse_tiers, 'daily:2:middle')
+    assert_raises(ValueError, backuppurge.parse_tiers, 'daily')
+
+    config = tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False)
+    try:
+        with config:
+            config.write('[/srv/backups]\ntiers = daily:7,yearly:3:last\n')
+        (directory, policy), = backuppurge.load_config(config.name, backuppurge.Policy())
+        assert_equal(policy.get_tiers(), [backuppurge.Tier('daily', 7),
+                                          backuppurge.Tier('yearly', 3, 'last')])
+    finally:
+        os.remove(config.name)
+
+def test_simulate_matches_daily_runs():
+    """
+    Test that simulated runs keep and purge the same backups as running
+    the policy every day on the backups kept by the previous run
+    """
+    start = datetime.datetime(2012, 1, 1)
+    filenames = [(start + datetime.timedelta(hours=hours)).strftime('db-%Y-%m-%dT%H.sql')
+                 for hours in range(0, 24 * 500, 7)]
+    sizes = dict((filename, len(filename) * index) for index, filename in enumerate(filenames))
+
+    for policy in (backuppurge.Policy(days=7, months=3, years=1, hours=12),
+                   backuppurge.Policy(tiers=backuppurge.parse_tiers('weekly:3:last,monthly:2')),
+                   backuppurge.Policy(days=30, max_total_size=200000)):
+        days = list(backuppurge.simulate(filenames, FixtureData.TODAY, 40, policy, None,
+                                         False, sizes=sizes))
+        assert_equal(len(days), 40)
+
+        backups = set()
+        begin = ''
+        for offset, day in enumerate(days):
+            today = FixtureData.TODAY + datetime.timedelta(days=offset)
+            end = (today + datetime.timedelta(days=1)).strftime('db-%Y-%m-%d')
+            backups.update(filename for filename in filenames if begin <= filename < end)
+            begin = end
+            purged = backuppurge.purge_filenames(sorted(backups), today, policy, None, False,
+                                                 sizes=dict(sizes))
+            backups.difference_update(purged)
+            assert_equal(day, {
+                'date': today.strftime('%Y-%m-%d'),
+                'kept': len(backups),
+                'purged': len(purged),
+                'kept_size': sum(sizes[filename] for filename in backups),
+                'purged_size': sum(sizes[filename] for filename in purged),
+            })
+
+def test_sharded_parsing_matches_single_process():
+    """
+    Test that parsing in worker processes gives the same purge lists
+    """
+    filenames = ['db-2013-03-31.sql', 'db-2013-02-30.sql', 'notes.txt',
+                 'db-2013-03-31T1200.sql', 'db-2012-12-24.sql']
+    filenames += ['www-{0}.tgz'.format(FixtureData.TODAY - datetime.timedelta(days=days))
+                  for days in range(100, -1, -1)]
+
+    for prefix, all_series in ((None, True), ('www-', False), ('db-', True)):
+        expected = backuppurge.get_purge_lists(filenames, FixtureData.TODAY,
+                                               backuppurge.Policy(), prefix, all_series)
+        sharded = backuppurge.get_purge_lists(filenames, FixtureData.TODAY,
+                                              backuppurge.Policy(), prefix, all_series,
+                                              jobs=2)
+        assert_equal([list(purge_list.plan_entries()) for purge_list in sharded],
+                     [list(purge_list.plan_entries()) for purge_list in expected])
+
+    # No backups at all, or none with the prefix
+    for names, prefix in (([], None), (['notes.txt'], None), (filenames, 'etc-')):
+        expected = backuppurge.purge_filenames(names, FixtureData.TODAY,
+                                               backuppurge.Policy(), prefix, False)
+        assert_equal(backuppurge.purge_filenames(names, FixtureData.TODAY,
+                                                 backuppurge.Policy(), prefix, False,
+                                                 jobs=2), expected)
+
+    series = backuppurge.parse_sharded(filenames, 2, chunk_size=7)
+    assert_equal(sorted(series), [('db-', '.sql'), ('www-', '.tgz')])
+    assert_equal(series[('db-', '.sql')][2], ['db-2013-02-30.sql'])
+    assert_false(series[('db-', '.sql')][3])
+    assert_true(series[('www-', '.tgz')][3])
+
+    assert_raises(backuppurge.MixedFilenames, backuppurge.get_purge_lists, filenames,
+                  FixtureData.TODAY, backuppurge.Policy(), None, False, jobs=2)
+
+def test_date_format_scanner():
+    """
+    Test that --date-format finds the last date of the first format that matches
+    """
+    parser = backuppurge.DateFormat(['%Y%m%d_%H%M', '%d.%m.%Y', '%y.%m.%d'])
+    assert_equal(parser('db_20130331_0300.sql'), ('db_', '2013-03-31T030000', '.sql'))
+    assert_equal(parser('v2_20130331_0300_20130401_1200'),
+                 ('v2_20130331_0300_', '2013-04-01T120000', ''))
+    assert_equal(parser('etc-99.12.31.tgz'), ('etc-', '1999-12-31', '.tgz'))
+    assert_equal(parser('etc-13.03.31.tgz'), ('etc-', '2013-03-31', '.tgz'))
+    assert_equal(parser(u'höme-31.03.2013'), (u'höme-', '2013-03-31', ''))
+    assert_equal(parser(u'h⌂me-31.03.2013'), (u'h⌂me-', '2013-03-31', ''))
+    assert_equal(parser('homedir-2013-03-31.tgz'), None)
+    assert_equal(parser('db_20130331120000.sql'), None)
+    assert_equal(parser('db_20130399_0300_20130301_0300'),
+                 ('db_20130399_0300_', '2013-03-01T030000', ''))
+    assert_equal(parser('db_20130331_2500.sql'), None)
+    assert_true('homedir-2013-03-31.tgz' in parser.parsed)
+
+    assert_equal(backuppurge.get_parser(None), backuppurge.parse_filename)
+    for format in ('%Y%m', '%Y1%m%d', '%Y%m%d%Y', '%y%m%d%Y', '%Y%m%d%j'):
+        assert_raises(ValueError, backuppurge.DateFormat, [format])
+
+    dates = [FixtureData.TODAY - datetime.timedelta(days=days) for days in range(400)]
+    expected = backuppurge.purge_filenames(
+        ['db-{0:%Y-%m-%d}.sql'.format(date) for date in dates],
+        FixtureData.TODAY, backuppurge.Policy(), None, False)
+    for jobs in (1, 2):
+        purged = backuppurge.purge_filenames(
+            ['db-{0:%Y%m%d}.sql'.format(date) for date in dates], FixtureData.TODAY,
+            backuppurge.Policy(), None, False, backuppurge.get_parser(['%Y%m%d']), jobs=jobs)
+        assert_equal(purged, [filename.replace('-', '').replace('db', 'db-')
+                              for filename in expected])
+
+def test_date_format_caches_paths_only():
+    """
+    Test that listing a directory with a date format only caches the
+    paths parsed again by PurgeList, not the names checked while listing
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for day in range(22, 32):
+            open(os.path.join(directory, 'db_201303{0:02d}.sql'.format(day)), 'w').close()
+        open(os.path.join(directory, 'README'), 'w').close()
+
+        parser = backuppurge.DateFormat(['%Y%m%d'])
+        purged = backuppurge.purge_filenames(
+            backuppurge.find_backups(directory, False, parser=parser),
+            FixtureData.TODAY, backuppurge.Policy(days=5, months=0, years=0),
+            None, False, parser)
+        assert_equal(len(purged), 5)
+        assert_equal(sorted(parser.parsed),
+                     sorted(os.path.join(directory, 'db_201303{0:02d}.sql'.format(day))
+                            for day in range(22, 32)))
+    finally:
+        shutil.rmtree(directory)
+
+class FakeClock:
+    """
+    Clock for Throttle that advances when sleeping, or by latency per call
+    """
+    def __init__(self):
+        self.now = 1000.
+        self.latency = 0.
+
+    def clock(self):
+        self.now += self.latency
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_throttled_delete_spreads_out_operations_and_bytes():
+    """
+    Test the delete rate limits, pauses on slow operations and removing
+    directory trees entry by entry
+    """
+    fake = FakeClock()
+    throttle = backuppurge.Throttle(10, 1000, clock=fake.clock, sleep=fake.sleep)
+    for _ in range(30):
+        throttle.wait(0)
+    # The first 10 operations are a burst, the other 20 take 2 seconds
+    assert_almost_equal(fake.now, 1002.)
+
+    throttle.wait(3000)
+    assert_almost_equal(fake.now, 1004.1)
+    assert_almost_equal(throttle.waited, 4.1)
+
+    fake = FakeClock()
+    throttle = backuppurge.Throttle(max_latency=0.5, clock=fake.clock, sleep=fake.sleep)
+    fake.latency = 0.4
+    with throttle.operation():
+        pass
+    assert_equal(throttle.pause, 0.)
+    fake.latency = 1.
+    for _ in range(3):
+        with throttle.operation():
+            pass
+    assert_equal(throttle.pause, 4.)
+
+    directory = tempfile.mkdtemp()
+    try:
+        backup = os.path.join(directory, 'home-2013-03-01')
+        os.makedirs(os.path.join(backup, 'etc', 'ssh'))
+        for name in ('passwd', os.path.join('ssh', 'sshd_config')):
+            with open(os.path.join(backup, 'etc', name), 'w') as fp:
+                fp.write('x' * 100)
+
+        fake = FakeClock()
+        deleter = backuppurge.Deleter(throttle=backuppurge.Throttle(
+            2, clock=fake.clock, sleep=fake.sleep))
+        deleter.delete([backup])
+        assert_equal(os.listdir(directory), [])
+        assert_equal((deleter.deleted, deleter.bytes_freed, deleter.inodes_freed), (1, 200, 5))
+        # 2 files and 3 directories, the first 2 of them without waiting
+        assert_almost_equal(fake.now, 1001.5)
+    finally:
+        shutil.rmtree(directory)
+
+def test_write_plan_as_jsonl_and_csv():
+    """
+    Test that plans list every file with decision, tier, bucket and date
+    """
+    filenames = ['backup-2013-03-31.tgz', 'backup-2013-02-30.tgz',
+                 'backup-2013-03-01T1200.tgz', 'backup-2013-03-30.tgz']
+    purge_list = backuppurge.PurgeList(filenames, FixtureData.TODAY, None)
+    backuppurge.Policy(days=1, months=2, years=0).apply(purge_list)
+    purge_list.unkeep('backup-2013-03-31.tgz', 'over size budget')
+
+    stream = io.StringIO()
+    backuppurge.write_plan([purge_list], 'jsonl', stream)
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert_equal(entries[0], {'path': 'backup-2013-03-01T1200.tgz', 'decision': 'keep',
+                              'tier': 'monthly', 'bucket': '2013-03',
+                              'date': '2013-03-01T12:00:00', 'reason': 'monthly (2013-03)'})
+    assert_equal([(entry['decision'], entry['reason']) for entry in entries[1:]], [
+        ('purge', None), ('purge', 'over size budget'), ('purge', 'invalid date')])
+
+    stream = io.StringIO()
+    backuppurge.write_plan([purge_list], 'csv', stream)
+    lines = stream.getvalue().splitlines()
+    assert_equal(lines[0], 'path,decision,tier,bucket,date,reason')
+    assert_equal(lines[2], 'backup-2013-03-30.tgz,purge,,,2013-03-30T00:00:00,')
+    assert_equal(len(lines), 5)
+
+def test_listing_backend_splits_on_newline_or_nul():
+    """
+    Test that paths can be read separated by newlines or NUL characters
+    """
+    for separator in (b'\n', b'\0'):
+        stream = io.BytesIO(separator.join([b'a/etc-2013-03-30.tgz',
+                                            b'a/etc-2013-03-31.tgz', b'']))
+        backend = backuppurge.ListingBackend(stream)
+
+        assert_equal(list(backend.list()), ['a/etc-2013-03-30.tgz', 'a/etc-2013-03-31.tgz'])
+
+def test_from_file_closes_listing():
+    """
+    Test that the listing file given with --from-file is closed
+    """
+    import gc
+    import warnings
+
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        listing = os.path.join(directory, 'listing')
+        with open(listing, 'w') as fp:
+            fp.write('etc-2013-03-30.tgz\netc-2013-03-31.tgz\n')
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            sys.stdout = io.TextIOWrapper(io.BytesIO())
+            assert_equal(backuppurge.main(None, 1, 0, 0, '\n', False, None,
+                                          from_file=listing), 0)
+            sys.stdout = stdout
+            gc.collect()
+
+        assert_equal([w for w in caught if issubclass(w.category, ResourceWarning)], [])
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+
+
+def test_read_paths_across_chunk_boundaries():
+    """
+    Test that paths split across chunk boundaries are read correctly
+    """
+    filenames = FixtureData.get_filenames()
+    stream = io.BytesIO('\0'.join(filenames).encode('ascii'))
+
+    paths = list(backuppurge.read_paths(stream, b'\0', chunk_size=7))
+
+    assert_equal(paths, filenames)
+
+
+class FakeS3Client:
+    """
+    Minimal in-memory stand-in for the boto3 S3 client API used by S3Backend
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.requests = 0
+
+    def get_paginator(self, operation):
+        assert_equal(operation, 'list_objects_v2')
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        keys = sorted(key for key in self.keys
+                      if key.startswith(Prefix) and Delimiter not in key[len(Prefix):])
+        for offset in range(0, len(keys), self.PAGE_SIZE):
+            self.requests += 1
+            yield {'Contents': [{'Key': key, 'Size': 10}
+                                for key in keys[offset:offset+self.PAGE_SIZE]]}
+
+    def delete_objects(self, Bucket, Delete):
+        self.requests += 1
+        assert len(Delete['Objects']) <= 1000
+        for obj in Delete['Objects']:
+            self.keys.remove(obj['Key'])
+        return {}
+
+
+def test_s3_backend_lists_pages_and_deletes_in_batches():
+    """
+    Test that S3 objects are listed page by page and deleted in batches
+    """
+    keys = ['backups/' + filename for filename in FixtureData.get_filenames()]
+    client = FakeS3Client(keys + ['backups/old/backup-2013-03-31.tar.gz'])
+    backend = backuppurge.S3Backend('s3://bucket/backups', client)
+
+    policy = backuppurge.Policy(days=30, months=0, years=0)
+    purge_files = backuppurge.purge_filenames(backend.list(), FixtureData.TODAY,
+                                              policy, None, False, backend.parse)
+    assert_equal(len(purge_files), len(keys) - 30)
+
+    deleter = backend.get_deleter(2)
+    deleter.delete(purge_files)
+
+    assert_equal(deleter.deleted, len(keys) - 30)
+    assert_equal(deleter.bytes_freed, 10 * (len(keys) - 30))
+    assert_equal(len(client.keys), 31)
+    # 11 pages of listing, 2 batches of deletes
+    assert_equal(client.requests, 13)
+
+def test_stats_count_phases():
+    """
+    Test that stats record the phases and counters of a purge
+    """
+    stats = backuppurge.Stats()
+    policy = backuppurge.Policy(days=30, months=6, years=2)
+
+    purge_files = backuppurge.purge_filenames(iter(FixtureData.get_filenames()),
+                                              FixtureData.TODAY, policy, None, False,
+                                              stats=stats)
+
+    assert_equal(set(stats.phases), {'list', 'parse', 'keep'})
+    assert_equal(stats.counters['regex_matches'], 3*365)
+    assert_equal(stats.counters['lookups'], 30 + 6 + 2)
+    assert_equal(stats.counters['purged'], len(purge_files))
+    assert_equal(stats.counters['kept'] + stats.counters['purged'], 3*365)
+    assert 'backuppurge_purged {0}\n'.format(len(purge_files)) in stats.to_prometheus()
+
+def test_size_budget_purges_lowest_tier_oldest_first():
+    """
+    Test that kept files are purged daily before monthly before yearly,
+    oldest first, until the size budget is met
+    """
+    filenames = FixtureData.get_filenames()
+    today = FixtureData.TODAY
+    policy = backuppurge.Policy(days=3, months=2, years=2, max_total_size=50)
+    sizes = dict((filename, 10) for filename in filenames)
+
+    purge_set = backuppurge.purge_filenames(filenames, today, policy, None, False,
+                                            sizes=sizes)
+    keep_set = set(filenames).difference(purge_set)
+
+    # Without budget, 7 files are kept: 3 daily, 2 monthly and 2 yearly;
+    # the two oldest daily backups are purged to get down to 5 files
+    expected_keep_set = {
+        'backup-2013-03-31.tar.gz',
+        'backup-2013-02-01.tar.gz', 'backup-2013-03-01.tar.gz',
+        'backup-2012-01-01.tar.gz', 'backup-2013-01-01.tar.gz',
+    }
+
+    assert_equal(keep_set, expected_keep_set)
+
+    # Weekly before quarterly, whatever the reasons look like
+    policy = backuppurge.Policy(tiers=backuppurge.parse_tiers('daily:2,weekly:2,quarterly:2'),
+                                max_total_size=30)
+    purge_lists = backuppurge.get_purge_lists(filenames, today, policy, None, False,
+                                              sizes=sizes)
+    assert_equal(sorted(purge_lists[0].kept_buckets.items()), [
+        ('backup-2012-10-01.tar.gz', '2012-Q4'), ('backup-2013-01-01.tar.gz', '2013-Q1'),
+        ('backup-2013-03-25.tar.gz', '2013-W13'),
+    ])
+    assert_equal(purge_lists[0].unkept, dict.fromkeys([
+        'backup-2013-03-18.tar.gz', 'backup-2013-03-30.tar.gz',
+        'backup-2013-03-31.tar.gz'], 'over size budget'))
+
+    assert_equal(backuppurge.parse_size('2G'), 2 * 1024**3)
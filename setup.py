@@ -6,12 +6,19 @@
 PACKAGE_NAME = 'backuppurge'
 
 # Assumptions:
-#  1. Package name equals main script file name (and only one script)
+#  1. Package name equals main script file name (and only one script),
+#     which calls main() in the "cli" module of the package
 #  2. Main script contains docstring + dunder-{author, license, url, version}
 #  3. Data files are in "share/", will be installed in $(PREFIX)/share
 #  4. Packages are in "lib/", no modules
 
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
+    setuptools = False
+else:
+    setuptools = True
 
 import os
 import re
@@ -25,7 +32,13 @@ m['author'], m['author_email'] = re.match(r'(.*) <(.*)>', m['author']).groups()
 m['description'], m['long_description'] = docs[0].strip().split('\n\n', 1)
 m['download_url'] = m['url'] + PACKAGE_NAME + '-' + m['version'] + '.tar.gz'
 
-m['scripts'] = [PACKAGE_NAME]
+if setuptools:
+    # The generated wrapper imports the package directly (no sys.path setup)
+    m['entry_points'] = {'console_scripts': [
+        '{0} = {0}.cli:main'.format(PACKAGE_NAME),
+    ]}
+else:
+    m['scripts'] = [PACKAGE_NAME]
 m['package_dir'] = {'': 'lib'}
 m['packages'] = ['.'.join(dirname.split(os.sep)[1:])
         for dirname, _, files in os.walk('lib') if '__init__.py' in files]